@@ -6,34 +6,49 @@
 """
 
 import os
-import io
+import re
 import sys
-import signal
 import logging
 import asyncio
 import time
+import functools
+import html
+import itertools
+import ssl
 from typing import Optional, List, Dict, Any, Callable, Awaitable
-from datetime import datetime, timedelta
+from collections import OrderedDict
+from datetime import datetime
 from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 from fastapi import FastAPI, Request, Response, UploadFile, File, Header, HTTPException
 from openai import AsyncOpenAI
+import httpx
 import uvicorn
+import aiohttp
+import certifi
 
 from aiogram import Bot, Dispatcher, types, F, BaseMiddleware
 from aiogram.filters import Command
+from aiogram.filters.callback_data import CallbackData
 from aiogram.types import (
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     ReplyKeyboardRemove,
     FSInputFile,
+    BufferedInputFile,
     TelegramObject,
     BotCommand,
 )
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from aiogram.exceptions import TelegramUnauthorizedError, TelegramNetworkError
-from aiogram.enums import ParseMode
+from aiogram.exceptions import (
+    TelegramUnauthorizedError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramBadRequest,
+)
+from aiogram.enums import ParseMode, ContentType
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
 
 import config
 import processors
@@ -58,8 +73,6 @@ def sanitize_llm_output(text: str) -> str:
        ```block```          → <code>block</code>
        ### Заголовок        → <b>Заголовок</b>
     """
-    import re
-
     # 1. Null-байты
     text = text.replace('\x00', '')
 
@@ -116,7 +129,6 @@ def sanitize_filename(raw: str, max_len: int) -> str:
     Кириллица сохраняется как есть (Telegram и FS её корректно отображают;
     транслитерация добавляет неоднозначность и не нужна).
     """
-    import re
     global _FILENAME_ALLOWED_RE
     if _FILENAME_ALLOWED_RE is None:
         _FILENAME_ALLOWED_RE = re.compile(r'[^A-Za-zА-Яа-яЁё0-9 _\-]')
@@ -136,6 +148,10 @@ def sanitize_filename(raw: str, max_len: int) -> str:
     return cleaned
 
 
+# Без strftime: форматирование даты идёт через locale и не различает экспорты внутри секунды
+_EXPORT_SEQ = itertools.count()
+
+
 def build_export_filename(
     user_id: int,
     mode: str,
@@ -145,18 +161,100 @@ def build_export_filename(
     Строит итоговое имя файла (без расширения).
 
     Формат:
-      [custom_name__]<mode>_<user_id>_<YYYYMMDD_HHMMSS>
+      [custom_name__]<mode>_<user_id>_<unix_time>_<seq>
 
-    user_id и timestamp обязательны — они защищают от race condition
-    при параллельных экспортах в общем /tmp.
+    user_id, время и счётчик процесса обязательны — два экспорта одного
+    пользователя в одну секунду не перезапишут друг друга.
     """
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    base = f"{mode}_{user_id}_{timestamp}"
+    base = f"{mode}_{user_id}_{int(time.time())}_{next(_EXPORT_SEQ)}"
     if custom_name:
         return f"{custom_name}__{base}"
     return f"export_{base}"
 
 
+# ============================================================================
+# УТИЛИТЫ: LRU-словарь с TTL
+# ============================================================================
+
+class TTLLRU(OrderedDict):
+    """
+    Словарь с вытеснением по LRU и по времени простоя.
+
+    - Чтение через [] / get() и запись поднимают ключ в конец очереди
+    - При переполнении capacity выселяется самый давно использованный ключ
+    - Ключ, к которому не обращались дольше ttl секунд, выселяется при чтении
+      или проверке `in` (сама проверка `in` ключ не освежает)
+    - on_evict(key, value) вызывается для каждого выселенного ключа
+      (явный pop/del/clear — не выселение, колбэк не зовётся)
+    """
+
+    def __init__(self, capacity: int, ttl: float, on_evict: Optional[Callable[[Any, Any], None]] = None):
+        super().__init__()
+        self.capacity = capacity
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self._touched: Dict[Any, float] = {}
+
+    def _evict(self, key):
+        value = super().pop(key)
+        self._touched.pop(key, None)
+        if self.on_evict:
+            try:
+                self.on_evict(key, value)
+            except Exception as e:
+                logger.debug("TTLLRU on_evict failed for %s: %s", key, e)
+
+    def evict_oldest(self):
+        """Выселяет самый давно использованный ключ (с on_evict) и возвращает его."""
+        key = next(iter(self))
+        self._evict(key)
+        return key
+
+    def _expired(self, key) -> bool:
+        return time.monotonic() - self._touched.get(key, 0.0) > self.ttl
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        self._touched[key] = time.monotonic()
+        while len(self) > self.capacity:
+            self._evict(next(iter(self)))
+
+    def __contains__(self, key) -> bool:
+        if not super().__contains__(key):
+            return False
+        if self._expired(key):
+            self._evict(key)
+            return False
+        return True
+
+    def __getitem__(self, key):
+        if super().__contains__(key) and self._expired(key):
+            self._evict(key)
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+        self._touched[key] = time.monotonic()
+        return value
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._touched.pop(key, None)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        self._touched.pop(key, None)
+        return super().pop(key, *default)
+
+    def clear(self):
+        super().clear()
+        self._touched.clear()
+
+
 # ============================================================================
 # УТИЛИТЫ: персистентность user_context в Supabase
 # ============================================================================
@@ -174,9 +272,10 @@ def _serialize_ctx(ctx_data: Dict[str, Any]) -> Dict[str, Any]:
         "transcript_id": ctx_data.get("transcript_id"),
         "is_translated": ctx_data.get("is_translated", False),
     }
+    # В памяти "time" — time.monotonic(); в БД пишем настенное время
     t = ctx_data.get("time")
-    if isinstance(t, datetime):
-        payload["time"] = t.isoformat()
+    if isinstance(t, (int, float)):
+        payload["time"] = datetime.fromtimestamp(time.time() - (time.monotonic() - t)).isoformat()
     elif isinstance(t, str):
         payload["time"] = t
     return payload
@@ -186,10 +285,12 @@ def _deserialize_ctx(payload: Dict[str, Any]) -> Dict[str, Any]:
     """Восстанавливает запись user_context из JSONB."""
     text = payload.get("original", "")
     t_raw = payload.get("time")
+    # Настенное время из БД → шкала time.monotonic() текущего процесса
     try:
-        t = datetime.fromisoformat(t_raw) if t_raw else datetime.now()
+        age = time.time() - datetime.fromisoformat(t_raw).timestamp() if t_raw else 0.0
     except (ValueError, TypeError):
-        t = datetime.now()
+        age = 0.0
+    t = time.monotonic() - max(age, 0.0)
 
     return {
         "text": text,
@@ -204,6 +305,7 @@ def _deserialize_ctx(payload: Dict[str, Any]) -> Dict[str, Any]:
         "filename": payload.get("filename"),
         "transcript_id": payload.get("transcript_id"),
         "is_translated": payload.get("is_translated", False),
+        "has_question_btn": len(text) > config.MIN_CHARS_FOR_QUESTION,
         "time": t,
     }
 
@@ -214,18 +316,18 @@ async def _persist_ctx(user_id: int, msg_id: int):
     Молча игнорирует ошибки — это не критичный путь.
     """
     try:
-        ctx = user_context.get(user_id, {}).get(msg_id)
+        ctx = get_ctx(user_id, msg_id)
         if not ctx:
             return
         await database.save_user_context(user_id, msg_id, _serialize_ctx(ctx))
     except Exception as e:
-        logger.debug(f"persist_ctx failed for {user_id}/{msg_id}: {e}")
+        logger.debug("persist_ctx failed for %s/%s: %s", user_id, msg_id, e)
 
 
 def schedule_persist(user_id: int, msg_id: int):
     """Запускает persist в фоне без await (вызывается из любых хендлеров)."""
     if database.is_available():
-        asyncio.create_task(_persist_ctx(user_id, msg_id))
+        _spawn(_persist_ctx(user_id, msg_id))
 
 try:
     import psutil
@@ -258,25 +360,113 @@ if not BOT_TOKEN:
     exit(1)
 
 # === ИНИЦИАЛИЗАЦИЯ БОТА ===
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher()
+class TelegramHTTPSession(AiohttpSession):
+    """
+    Одна keep-alive сессия к api.telegram.org: правки стрима не платят за новый TLS-handshake.
+    aiogram пробрасывает в TCPConnector только limit, а настройки коннектора хранит
+    в приватных атрибутах, которые меняются между версиями. Поэтому ClientSession
+    собираем сами в публичных create_session/close, которые aiogram и вызывает.
+    """
+
+    def __init__(self):
+        super().__init__(limit=config.TELEGRAM_HTTP_LIMIT)
+        self._client: Optional[aiohttp.ClientSession] = None
+
+    async def create_session(self) -> aiohttp.ClientSession:
+        if self._client is None or self._client.closed:
+            connector = aiohttp.TCPConnector(
+                # certifi — как у самого aiogram: в slim-образах системных сертификатов может не быть
+                ssl=ssl.create_default_context(cafile=certifi.where()),
+                limit=config.TELEGRAM_HTTP_LIMIT,
+                limit_per_host=config.TELEGRAM_HTTP_LIMIT_PER_HOST,
+                keepalive_timeout=config.TELEGRAM_HTTP_KEEPALIVE,
+                ttl_dns_cache=config.TELEGRAM_HTTP_DNS_TTL,
+            )
+            self._client = aiohttp.ClientSession(connector=connector)
+        return self._client
+
+    async def close(self) -> None:
+        if self._client is not None and not self._client.closed:
+            await self._client.close()
+
+
+telegram_session = TelegramHTTPSession()
+bot = Bot(
+    token=BOT_TOKEN,
+    session=telegram_session,
+    default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+)
+# FSM не используется (состояние живёт в user_context) — не гоняем FSM-middleware на каждом апдейте
+dp = Dispatcher(disable_fsm=True)
 
 # === ГЛОБАЛЬНЫЕ ПЕРЕМЕННЫЕ ===
 start_time = time.time()
 polling_task = None
 is_shutting_down = False
 shutdown_event = asyncio.Event()
+# Задачи, которые сейчас обрабатывают апдейты, — shutdown ждёт именно их, а не таймер
+_inflight_tasks: set = set()
+# Фоновые записи в БД, ack колбэков и т.п.
+_background_tasks: set = set()
 stats = {"total_updates": 0, "errors": 0, "processed_messages": 0}
 
+def _on_user_context_evict(user_id: int, messages: Dict[int, Any]):
+    """Выселенный из user_context пользователь теряет и документы для диалога."""
+    dialogues = processors.document_dialogues.get(user_id)
+    if dialogues:
+        for msg_id in messages:
+            dialogues.pop(msg_id, None)
+        if not dialogues:
+            processors.document_dialogues.pop(user_id, None)
+
+
 # Контекст: user_id -> { message_id: {...} }
-user_context: Dict[int, Dict[int, Any]] = {}
+user_context: Dict[int, Dict[int, Any]] = TTLLRU(
+    capacity=config.USER_CONTEXT_CAPACITY,
+    ttl=config.USER_CONTEXT_TTL_SEC,
+    on_evict=_on_user_context_evict,
+)
+
+_NO_CONTEXTS: Dict[int, Any] = {}
+
+
+def get_ctx(user_id: int, msg_id: int) -> Optional[Dict[str, Any]]:
+    """Запись user_context или None; без нового пустого dict на каждый промах."""
+    return user_context.get(user_id, _NO_CONTEXTS).get(msg_id)
+
+
+async def fetch_ctx(user_id: int, msg_id: int) -> Optional[Dict[str, Any]]:
+    """
+    get_ctx + подгрузка из Supabase: память держит только горячие записи (TTLLRU),
+    а вытесненная запись по нажатию кнопки возвращается из БД, а не «устаревает».
+    """
+    ctx = get_ctx(user_id, msg_id)
+    if ctx is not None or not database.is_available():
+        return ctx
+    row = await database.load_user_context(user_id, msg_id, config.CACHE_TIMEOUT_SECONDS)
+    if not row:
+        return None
+    ctx = _deserialize_ctx(row.get("payload") or {})
+    if user_id not in user_context:
+        user_context[user_id] = {}
+    user_context[user_id][msg_id] = ctx
+    return ctx
+
 
 # Активные диалоги: user_id -> message_id документа
-active_dialogs: Dict[int, int] = {}
+# Кто не нажал «Выйти», выселяется по простою — словарь не растёт бесконечно
+active_dialogs: Dict[int, int] = TTLLRU(
+    capacity=config.ACTIVE_DIALOGS_CAPACITY,
+    ttl=config.ACTIVE_DIALOGS_TTL_SEC,
+)
 
 # Rate limiting: user_id пользователей, у которых идёт обработка прямо сейчас
 processing_users: set = set()
 
+# Временные файлы, созданные этим процессом и ещё не удалённые: /status и shutdown
+# работают по этому списку, а не обходят TEMP_DIR
+active_temp_files: set = set()
+
 # Ожидание ввода имени файла перед экспортом
 # user_id -> {
 #   "mode": str, "msg_id": int, "format": str,
@@ -285,24 +475,13 @@ processing_users: set = set()
 # }
 pending_filename_inputs: Dict[int, Dict[str, Any]] = {}
 
-groq_clients = []
-
+# Склейка вставок, порезанных Telegram на несколько сообщений:
+# user_id -> ([сообщения], TimerHandle отложенной обработки)
+_pending_text: Dict[int, tuple] = {}
 
-# ============================================================================
-# ОБРАБОТКА СИГНАЛОВ (GRACEFUL SHUTDOWN)
-# ============================================================================
-
-def handle_sigterm(signum, frame):
-    global is_shutting_down
-    if is_shutting_down:
-        return
-    logger.info("📡 Received SIGTERM, initiating graceful shutdown...")
-    is_shutting_down = True
-    try:
-        loop = asyncio.get_running_loop()
-        loop.call_soon_threadsafe(lambda: asyncio.create_task(shutdown_event.set()))
-    except RuntimeError:
-        asyncio.run(shutdown_event.set())
+groq_clients = []
+# Общий httpx-пул для всех Groq-клиентов: TCP/TLS-сессии переиспользуются между ключами
+groq_http_client: Optional[httpx.AsyncClient] = None
 
 
 # ============================================================================
@@ -324,15 +503,15 @@ class ErrorHandlingMiddleware(BaseMiddleware):
             return result
         except TelegramUnauthorizedError as e:
             stats["errors"] += 1
-            logger.error(f"❌ Ошибка авторизации: {e}")
+            logger.error("❌ Ошибка авторизации: %s", e)
             raise
         except TelegramNetworkError as e:
             stats["errors"] += 1
-            logger.error(f"❌ Сетевая ошибка: {e}")
+            logger.error("❌ Сетевая ошибка: %s", e)
             raise
         except Exception as e:
             stats["errors"] += 1
-            logger.error(f"❌ Необработанная ошибка: {e}", exc_info=True)
+            logger.error("❌ Необработанная ошибка: %s", e, exc_info=True)
             if is_shutting_down:
                 raise
             try:
@@ -341,12 +520,49 @@ class ErrorHandlingMiddleware(BaseMiddleware):
                 elif hasattr(event, "callback_query") and event.callback_query:
                     await event.callback_query.message.answer("❌ Произошла внутренняя ошибка.")
             except Exception as notify_err:
-                logger.debug(f"Не смогли уведомить пользователя об ошибке: {notify_err}")
+                logger.debug("Не смогли уведомить пользователя об ошибке: %s", notify_err)
             raise
 
 
-dp.message.middleware(ErrorHandlingMiddleware())
-dp.callback_query.middleware(ErrorHandlingMiddleware())
+class InflightMiddleware(BaseMiddleware):
+    """Регистрирует задачу обработчика в _inflight_tasks на время обработки апдейта."""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        task = asyncio.current_task()
+        _inflight_tasks.add(task)
+        try:
+            return await handler(event, data)
+        finally:
+            _inflight_tasks.discard(task)
+
+
+def _spawn(coro) -> asyncio.Task:
+    """Fire-and-forget с сильной ссылкой: loop держит задачи слабо, и без неё GC может их прибить."""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+
+def _track_task(coro) -> asyncio.Task:
+    """create_task для фоновой обработки вне апдейта (склеенный текст) — тоже дожидаемся при остановке."""
+    task = asyncio.create_task(coro)
+    _inflight_tasks.add(task)
+    task.add_done_callback(_inflight_tasks.discard)
+    return task
+
+
+# Состояния у middleware нет — один экземпляр на оба типа событий
+_error_middleware = ErrorHandlingMiddleware()
+_inflight_middleware = InflightMiddleware()
+for _observer in (dp.message, dp.callback_query):
+    _observer.outer_middleware(_inflight_middleware)
+    _observer.middleware(_error_middleware)
 
 
 # ============================================================================
@@ -358,13 +574,15 @@ async def run_polling():
     logger.info("🚀 Starting bot polling task...")
     while not is_shutting_down:
         try:
-            await dp.start_polling(bot)
+            # Сигналы принадлежат uvicorn: свои обработчики aiogram перехватили бы SIGTERM,
+            # и сервер не узнал бы об остановке
+            await dp.start_polling(bot, handle_signals=False)
         except asyncio.CancelledError:
             break
         except Exception as e:
             if is_shutting_down:
                 break
-            logger.error(f"❌ Polling crashed: {e}. Restarting in 5s...", exc_info=True)
+            logger.error("❌ Polling crashed: %s. Restarting in 5s...", e, exc_info=True)
             await asyncio.sleep(5)
 
 
@@ -372,21 +590,46 @@ async def run_polling():
 # FASTAPI
 # ============================================================================
 
+async def _clear_webhook():
+    try:
+        await bot.delete_webhook(drop_pending_updates=True)
+        logger.info("✅ Webhook cleared")
+    except Exception as e:
+        logger.error("❌ Error clearing webhook: %s", e)
+
+
+async def _set_commands():
+    """Меню команд (кнопка «Меню» в интерфейсе Telegram)."""
+    try:
+        await bot.set_my_commands([
+            BotCommand(command="start",   description="👋 О боте"),
+            BotCommand(command="help",    description="📋 Инструкция"),
+            BotCommand(command="history", description="📜 История обработок"),
+        ])
+        logger.info("✅ Bot commands menu set")
+    except Exception as e:
+        logger.warning("⚠️ Could not set bot commands: %s", e)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global polling_task
+    global polling_task, is_shutting_down
 
     logger.info("=" * 50)
     logger.info("🟢 FASTAPI APP STARTING")
     logger.info("=" * 50)
 
-    # Groq клиенты
+    # Groq клиенты (проверка ключей идёт ниже, параллельно с настройкой Telegram)
     init_groq_clients()
     processors.vision_processor.init_clients(groq_clients)
 
     if not hasattr(processors, 'document_dialogues'):
         processors.document_dialogues = {}
 
+    # Временные каталоги создаём один раз — дальше код считает, что они есть
+    for path in (config.TEMP_DIR, config.EXPORT_DIR):
+        os.makedirs(path, exist_ok=True)
+
     # Supabase
     db_ok = database.init_database()
     if db_ok:
@@ -395,6 +638,8 @@ async def lifespan(app: FastAPI):
         try:
             records = await database.load_active_user_contexts(config.CACHE_TIMEOUT_SECONDS)
             restored = 0
+            # Порядок вставки = порядок вытеснения, поэтому восстанавливаем от старых к новым
+            records.sort(key=lambda r: r.get("updated_at") or "")
             for rec in records:
                 uid = rec.get("user_id")
                 mid = rec.get("msg_id")
@@ -405,46 +650,23 @@ async def lifespan(app: FastAPI):
                     user_context[uid] = {}
                 user_context[uid][mid] = _deserialize_ctx(payload)
                 restored += 1
-            logger.info(f"♻️  Восстановлено {restored} user_context из БД")
+            logger.info("♻️  Восстановлено %s user_context из БД", restored)
         except Exception as e:
-            logger.warning(f"⚠️  Не удалось восстановить user_context: {e}")
+            logger.warning("⚠️  Не удалось восстановить user_context: %s", e)
     else:
         logger.info("📦 Работаем без базы данных")
 
-    # Сброс вебхука
-    try:
-        await bot.delete_webhook(drop_pending_updates=True)
-        logger.info("✅ Webhook cleared")
-    except Exception as e:
-        logger.error(f"❌ Error clearing webhook: {e}")
-
-    # Меню команд (кнопка «Меню» в интерфейсе Telegram)
-    try:
-        await bot.set_my_commands([
-            BotCommand(command="start",   description="👋 О боте"),
-            BotCommand(command="help",    description="📋 Инструкция"),
-            BotCommand(command="history", description="📜 История обработок"),
-        ])
-        logger.info("✅ Bot commands menu set")
-    except Exception as e:
-        logger.warning(f"⚠️ Could not set bot commands: {e}")
+    # Пинг Groq-ключей, сброс вебхука и меню команд друг от друга не зависят —
+    # холодный старт ждёт самый долгий запрос, а не сумму всех
+    await asyncio.gather(validate_groq_clients(), _clear_webhook(), _set_commands())
 
     # Запуск polling
     polling_task = asyncio.create_task(run_polling())
 
     # Фоновые задачи
-    cleanup_task = asyncio.create_task(cleanup_old_contexts())
-    temp_cleanup_task = asyncio.create_task(cleanup_temp_files())
+    maintenance_task = asyncio.create_task(maintenance_loop())
     db_keepalive_task = asyncio.create_task(database.keep_alive_loop())
 
-    # Сигналы
-    loop = asyncio.get_running_loop()
-    for sig in (signal.SIGTERM, signal.SIGINT):
-        try:
-            loop.add_signal_handler(sig, handle_sigterm, sig, None)
-        except NotImplementedError:
-            pass
-
     logger.info("=" * 50)
     logger.info("✅ BOT IS RUNNING")
     logger.info("=" * 50)
@@ -453,7 +675,15 @@ async def lifespan(app: FastAPI):
 
     # === SHUTDOWN ===
     logger.info("🔴 SHUTTING DOWN")
+    # SIGTERM/SIGINT ловит uvicorn и приводит нас сюда — run_polling не должен перезапуститься
+    is_shutting_down = True
+    shutdown_event.set()
 
+    # Сначала перестаём принимать апдейты, потом ждём уже начатые
+    try:
+        await dp.stop_polling()
+    except RuntimeError:
+        pass  # polling не запущен или уже остановлен
     if polling_task and not polling_task.done():
         polling_task.cancel()
         try:
@@ -461,20 +691,49 @@ async def lifespan(app: FastAPI):
         except asyncio.CancelledError:
             pass
 
-    for task in [cleanup_task, temp_cleanup_task, db_keepalive_task]:
+    # Склеиваемый текст, до которого не дошёл таймер, не теряем молча: разбираем сейчас,
+    # _process_text ответит пользователю, что бот останавливается
+    for user_id in list(_pending_text):
+        _flush_pending_text(user_id)
+
+    # Даём начатым обработкам дойти до конца, но не дольше SHUTDOWN_DRAIN_TIMEOUT;
+    # в простое это мгновенно — ждём события завершения задач, а не тикаем таймером
+    inflight = {t for t in _inflight_tasks | _background_tasks if not t.done()}
+    if inflight:
+        _, pending = await asyncio.wait(inflight, timeout=config.SHUTDOWN_DRAIN_TIMEOUT)
+        if pending:
+            logger.warning("⏱ Shutdown: %s обработок не успели завершиться", len(pending))
+
+    for task in (maintenance_task, db_keepalive_task):
         task.cancel()
-    await asyncio.gather(cleanup_task, temp_cleanup_task, db_keepalive_task, return_exceptions=True)
+    await asyncio.gather(maintenance_task, db_keepalive_task, return_exceptions=True)
 
     user_context.clear()
     active_dialogs.clear()
     processing_users.clear()
+    create_dialog_keyboard.cache_clear()
+    _keyboard_markup.cache_clear()
+    _ask_question_button.cache_clear()
+    _options_markup.cache_clear()
+    _switch_markup.cache_clear()
     if hasattr(processors, 'document_dialogues'):
         processors.document_dialogues.clear()
 
     try:
         await bot.session.close()
     except Exception as e:
-        logger.debug(f"bot.session.close failed during shutdown: {e}")
+        logger.debug("bot.session.close failed during shutdown: %s", e)
+
+    # Недоудалённое этим процессом (прерванные загрузки и экспорты) — по списку, без обхода /tmp
+    removed = await asyncio.to_thread(_remove_tracked_temp_files)
+    if removed:
+        logger.info("🧹 Shutdown: удалено %s временных файлов", removed)
+
+    if groq_http_client is not None:
+        try:
+            await groq_http_client.aclose()
+        except Exception as e:
+            logger.debug("groq_http_client.aclose failed during shutdown: %s", e)
 
     logger.info("✅ BOT STOPPED")
 
@@ -492,14 +751,27 @@ async def monitor_requests(request: Request, call_next):
         raise
 
 
+# Тело health-ответа — готовые байты, а не строка на каждый запрос
+_HEALTH_BODY = b'{"status": "healthy", "service": "igramotey", "version": "4.0"}'
+_HEALTH_PATHS = frozenset(("/health", "/ping"))
+
+
+class _HealthAccessFilter(logging.Filter):
+    """Не пишет в access-лог пробы liveness/readiness — при опросе раз в секунду они забивают лог."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        args = record.args
+        return not (isinstance(args, tuple) and len(args) > 2 and args[2] in _HEALTH_PATHS)
+
+
+logging.getLogger("uvicorn.access").addFilter(_HealthAccessFilter())
+
+
 @app.get("/health")
 @app.head("/health")
 @app.get("/ping")
 async def health():
-    return Response(
-        content='{"status": "healthy", "service": "igramotey", "version": "4.0"}',
-        media_type="application/json", status_code=200
-    )
+    return Response(content=_HEALTH_BODY, media_type="application/json", status_code=200)
 
 
 @app.get("/")
@@ -524,7 +796,7 @@ bot_users_in_context {len(user_context)}
             ram_mb = psutil.Process().memory_info().rss / 1024 / 1024
             text += f"bot_ram_mb {ram_mb:.2f}\n"
         except Exception as e:
-            logger.debug(f"psutil RAM read failed: {e}")
+            logger.debug("psutil RAM read failed: %s", e)
     return Response(content=text, media_type="text/plain")
 
 
@@ -546,7 +818,7 @@ async def api_dictate(
     """
     # Простейшая защита
     if x_app_token != APP_SECRET_TOKEN:
-        logger.warning(f"API unauthorized attempt with token: {x_app_token}")
+        logger.warning("API unauthorized attempt with token: %s", x_app_token)
         raise HTTPException(status_code=403, detail="Forbidden")
 
     # Проверяем наличие Groq клиентов
@@ -563,14 +835,14 @@ async def api_dictate(
             return {"status": "error", "text": "Файл слишком большой (макс. 20 МБ)"}
         
         # Логируем запрос
-        logger.info(f"API Dictate: file={file.filename}, size={len(audio_bytes)} bytes")
+        logger.info("API Dictate: file=%s, size=%s bytes", file.filename, len(audio_bytes))
         
         # Транскрибация (Whisper через Groq)
         raw_text = await processors.transcribe_voice(audio_bytes, groq_clients)
         
         # Проверка результата
         if raw_text.startswith("❌"):
-            logger.error(f"API Dictate transcription error: {raw_text}")
+            logger.error("API Dictate transcription error: %s", raw_text)
             return {"status": "error", "text": raw_text}
             
         if len(raw_text.strip()) < 2:
@@ -583,7 +855,7 @@ async def api_dictate(
             corrected_text = await processors.correct_text_premium(raw_text, groq_clients)
         
         if corrected_text.startswith("❌"):
-            logger.error(f"API Dictate correction error: {corrected_text}")
+            logger.error("API Dictate correction error: %s", corrected_text)
             return {"status": "error", "text": corrected_text}
 
         # Чистим от маркдауна и лишних символов
@@ -595,7 +867,7 @@ async def api_dictate(
                      .strip())
         
         # Логируем успех
-        logger.info(f"API Dictate success: {len(raw_text)} → {len(clean_text)} chars")
+        logger.info("API Dictate success: %s → %s chars", len(raw_text), len(clean_text))
         
         return {
             "status": "success", 
@@ -605,7 +877,7 @@ async def api_dictate(
         }
 
     except Exception as e:
-        logger.error(f"API Dictate error: {e}", exc_info=True)
+        logger.error("API Dictate error: %s", e, exc_info=True)
         return {"status": "error", "text": f"Ошибка сервера: {str(e)[:50]}"}
 
 
@@ -622,7 +894,7 @@ async def api_correct(
     """
     # Простейшая защита
     if x_app_token != APP_SECRET_TOKEN:
-        logger.warning(f"API /correct unauthorized attempt with token: {x_app_token}")
+        logger.warning("API /correct unauthorized attempt with token: %s", x_app_token)
         raise HTTPException(status_code=403, detail="Forbidden")
 
     if not groq_clients:
@@ -639,7 +911,7 @@ async def api_correct(
         if len(text) > 20000:
             return {"status": "error", "text": "Текст слишком большой (макс. 20000 символов)"}
 
-        logger.info(f"API Correct: {len(text)} chars")
+        logger.info("API Correct: %s chars", len(text))
 
         # Делаем коррекцию выбранным стилем (APP_CORR_STYLE: basic или premium)
         if APP_CORR_STYLE == "basic":
@@ -648,7 +920,7 @@ async def api_correct(
             corrected_text = await processors.correct_text_premium(text, groq_clients)
 
         if corrected_text.startswith("❌"):
-            logger.error(f"API Correct error: {corrected_text}")
+            logger.error("API Correct error: %s", corrected_text)
             return {"status": "error", "text": corrected_text}
 
         # Чистим от маркдауна
@@ -659,7 +931,7 @@ async def api_correct(
                       .replace("#", "")
                       .strip())
 
-        logger.info(f"API Correct success: {len(text)} → {len(clean_text)} chars")
+        logger.info("API Correct success: %s → %s chars", len(text), len(clean_text))
 
         return {
             "status": "success",
@@ -669,7 +941,7 @@ async def api_correct(
         }
 
     except Exception as e:
-        logger.error(f"API Correct error: {e}", exc_info=True)
+        logger.error("API Correct error: %s", e, exc_info=True)
         return {"status": "error", "text": f"Ошибка сервера: {str(e)[:50]}"}
 
 
@@ -678,20 +950,57 @@ async def api_correct(
 # ============================================================================
 
 def init_groq_clients():
-    global groq_clients
+    global groq_clients, groq_http_client
     if not GROQ_API_KEYS:
         logger.warning("GROQ_API_KEYS not configured!")
         return
     keys = [k.strip() for k in GROQ_API_KEYS.split(",") if k.strip()]
+
+    # Один пул соединений на все ключи — без нового TLS-handshake на каждый вызов
+    groq_http_client = httpx.AsyncClient(
+        timeout=config.GROQ_TIMEOUT,
+        limits=httpx.Limits(
+            max_connections=config.GROQ_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=config.GROQ_HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=config.GROQ_HTTP_KEEPALIVE_EXPIRY,
+        ),
+        http2=True,
+    )
+
     for key in keys:
         try:
-            client = AsyncOpenAI(api_key=key, base_url="https://api.groq.com/openai/v1", timeout=config.GROQ_TIMEOUT)
+            client = AsyncOpenAI(
+                api_key=key,
+                base_url="https://api.groq.com/openai/v1",
+                timeout=config.GROQ_TIMEOUT,
+                http_client=groq_http_client,
+            )
             groq_clients.append(client)
-            logger.info(f"✅ Groq client: {key[:8]}...")
+            logger.debug("Groq client: %s...", key[:8])
         except Exception as e:
-            logger.error(f"❌ Error init client {key[:8]}...: {e}")
-    logger.info(f"✅ Total Groq clients: {len(groq_clients)}")
-    logger.info(f"🎨 APP_CORR_STYLE = {APP_CORR_STYLE}")
+            logger.error("❌ Error init client %s...: %s", key[:8], e)
+    logger.info("✅ Total Groq clients: %s", len(groq_clients))
+    logger.info("🎨 APP_CORR_STYLE = %s", APP_CORR_STYLE)
+
+
+async def _ping_groq(client: AsyncOpenAI) -> bool:
+    try:
+        await asyncio.wait_for(client.models.list(), timeout=config.GROQ_PING_TIMEOUT)
+        return True
+    except Exception as e:
+        logger.warning("⚠️  Groq key %s... не отвечает: %s", client.api_key[:8], e)
+        return False
+
+
+async def validate_groq_clients():
+    """Пингует все ключи параллельно (одно RTT вместо N) и убирает мёртвые."""
+    if not groq_clients:
+        return
+    alive = await asyncio.gather(*(_ping_groq(c) for c in groq_clients))
+    # Если не ответил ни один — скорее сеть на старте, а не ключи: оставляем всех
+    if any(alive):
+        groq_clients[:] = [c for c, ok in zip(groq_clients, alive) if ok]
+    logger.info("✅ Live Groq clients: %s/%s", len(groq_clients), len(alive))
 
 
 # ============================================================================
@@ -702,12 +1011,14 @@ def save_to_history(user_id: int, msg_id: int, text: str, mode: str = "basic", a
     if user_id not in user_context:
         user_context[user_id] = {}
     if len(user_context[user_id]) > config.MAX_CONTEXTS_PER_USER:
-        oldest = min(user_context[user_id].keys(), key=lambda k: user_context[user_id][k]['time'])
-        user_context[user_id].pop(oldest)
+        # Записи вставляются по времени создания — самая старая всегда первая
+        user_context[user_id].pop(next(iter(user_context[user_id])))
     user_context[user_id][msg_id] = {
-        "text": text, "mode": mode, "time": datetime.now(),
+        "text": text, "mode": mode, "time": time.monotonic(),
         "available_modes": available_modes or ["basic"],
         "original": text,
+        # Кнопка «Задать вопрос» зависит только от длины — считаем при сохранении
+        "has_question_btn": len(text) > config.MIN_CHARS_FOR_QUESTION,
         "cached_results": {"basic": None, "premium": None, "summary": None},
         "type": "text", "chat_id": None, "filename": None,
         "transcript_id": None,   # для связи с БД
@@ -716,191 +1027,444 @@ def save_to_history(user_id: int, msg_id: int, text: str, mode: str = "basic", a
     schedule_persist(user_id, msg_id)
 
 
-async def cleanup_old_contexts():
-    while not is_shutting_down and not shutdown_event.is_set():
+def _ctx_chars(messages: Dict[int, Any]) -> int:
+    """Примерный вес записей пользователя: оригинал + закэшированные результаты, в символах."""
+    total = 0
+    for ctx in messages.values():
+        total += len(ctx.get("original") or "")
+        for res in (ctx.get("cached_results") or {}).values():
+            if res:
+                total += len(res)
+    return total
+
+
+def _enforce_context_budget() -> int:
+    """
+    Держит суммарный объём текстов в user_context под USER_CONTEXT_MAX_CHARS:
+    выселяет самых давно активных пользователей. Возвращает число выселенных.
+    """
+    sizes = {uid: _ctx_chars(messages) for uid, messages in user_context.items()}
+    total = sum(sizes.values())
+    evicted = 0
+    while total > config.USER_CONTEXT_MAX_CHARS and user_context:
+        uid = user_context.evict_oldest()
+        total -= sizes.get(uid, 0)
+        evicted += 1
+    return evicted
+
+
+async def _expire_contexts():
+    cutoff = time.monotonic() - config.CACHE_TIMEOUT_SECONDS
+
+    # Один проход на сбор просроченного, удаление — пачкой после обхода
+    expired = [
+        (user_id, messages, msg_id)
+        for user_id, messages in user_context.items()
+        for msg_id, ctx in messages.items()
+        if ctx.get("time", cutoff) < cutoff
+    ]
+    emptied = []
+    for user_id, messages, msg_id in expired:
+        messages.pop(msg_id, None)
+        dialogues = processors.document_dialogues.get(user_id)
+        if dialogues:
+            dialogues.pop(msg_id, None)
+            if not dialogues:
+                processors.document_dialogues.pop(user_id, None)
+        if not messages:
+            emptied.append(user_id)
+    for user_id in emptied:
+        user_context.pop(user_id, None)
+    if expired:
+        logger.debug("🧹 expired %d contexts", len(expired))
+
+    evicted = _enforce_context_budget()
+    if evicted:
+        logger.info("🧹 user_context over budget, evicted %s users", evicted)
+
+    # Чистим устаревшее в БД (один общий sweep — дешевле, чем N запросов)
+    if database.is_available():
         try:
-            await asyncio.sleep(config.CACHE_CHECK_INTERVAL)
-            if is_shutting_down:
-                break
-            current_time = datetime.now()
-            users_to_clean = []
-            stale_keys: List[tuple] = []  # (user_id, msg_id) для удаления из БД
-
-            for user_id, messages in user_context.items():
-                for msg_id, ctx in list(messages.items()):
-                    age = (current_time - ctx.get("time", current_time)).total_seconds()
-                    if age > config.CACHE_TIMEOUT_SECONDS:
-                        messages.pop(msg_id, None)
-                        stale_keys.append((user_id, msg_id))
-                if not messages:
-                    users_to_clean.append(user_id)
-            for uid in users_to_clean:
-                user_context.pop(uid, None)
-
-            # Чистим устаревшее в БД (один общий sweep — дешевле, чем N запросов)
-            if database.is_available():
-                try:
-                    await database.cleanup_stale_user_contexts(config.CACHE_TIMEOUT_SECONDS)
-                    # YouTube-кэш чистим раз в сутки по last_accessed
-                    await database.cleanup_stale_youtube_cache(max_age_days=30)
-                except Exception as e:
-                    logger.debug(f"DB cleanup failed: {e}")
-        except asyncio.CancelledError:
-            break
+            await database.cleanup_stale_user_contexts(config.CACHE_TIMEOUT_SECONDS)
+            # YouTube-кэш чистим раз в сутки по last_accessed
+            await database.cleanup_stale_youtube_cache(max_age_days=30)
         except Exception as e:
-            logger.error(f"Cache cleanup error: {e}")
+            logger.debug("DB cleanup failed: %s", e)
+
+
+def _sweep_temp_files(now: float, in_use: frozenset) -> int:
+    """
+    Удаляет протухшие временные файлы; os.scandir не собирает листинг целиком.
+    in_use — снимок active_temp_files: долгая расшифровка держит файл дольше
+    TEMP_FILE_RETENTION, и удалять его из-под ffmpeg/Whisper нельзя.
+    """
+    deleted = 0
+
+    def _expired(entry, retention: int) -> bool:
+        if entry.path in in_use:
+            return False
+        try:
+            return entry.is_file(follow_symlinks=False) and now - entry.stat().st_mtime > retention
+        except OSError:
+            return False
+
+    def _unlink(path: str):
+        nonlocal deleted
+        try:
+            os.remove(path)
+            deleted += 1
+        except OSError as e:
+            logger.debug("Не смогли удалить %s: %s", path, e)
+
+    # Каталоги создаются на старте: без отдельной проверки существования, scandir сам скажет
+    try:
+        with os.scandir(config.TEMP_DIR) as it:
+            for entry in it:
+                if entry.name.startswith(config.TEMP_FILE_PREFIXES) and _expired(entry, config.TEMP_FILE_RETENTION):
+                    _unlink(entry.path)
+    except FileNotFoundError:
+        pass
 
+    # Экспорты: шарды по user_id, забытые после падения файлы живут не дольше часа
+    try:
+        with os.scandir(config.EXPORT_DIR) as shards:
+            for shard in shards:
+                if not shard.is_dir(follow_symlinks=False):
+                    continue
+                with os.scandir(shard.path) as it:
+                    for entry in it:
+                        if _expired(entry, config.EXPORT_FILE_RETENTION):
+                            _unlink(entry.path)
+    except FileNotFoundError:
+        pass
+    return deleted
 
-async def cleanup_temp_files():
-    while not is_shutting_down and not shutdown_event.is_set():
+
+def _remove_tracked_temp_files() -> int:
+    """Для shutdown: удаляет только то, что создал этот процесс, без обхода каталогов."""
+    deleted = 0
+    for path in list(active_temp_files):
         try:
-            await asyncio.sleep(config.TEMP_FILE_RETENTION)
-            if is_shutting_down or not config.CLEANUP_TEMP_FILES:
-                continue
-            current_time = datetime.now().timestamp()
-            if not os.path.exists(config.TEMP_DIR):
-                continue
-            deleted = 0
-            for filename in os.listdir(config.TEMP_DIR):
-                if filename.startswith(('video_', 'audio_', 'text_', 'export_')):
-                    filepath = os.path.join(config.TEMP_DIR, filename)
-                    try:
-                        if current_time - os.path.getmtime(filepath) > config.TEMP_FILE_RETENTION:
-                            os.remove(filepath)
-                            deleted += 1
-                    except OSError as e:
-                        logger.debug(f"Не смогли удалить {filepath}: {e}")
-            if deleted:
-                logger.debug(f"Cleaned up {deleted} temp files")
+            os.remove(path)
+            deleted += 1
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.debug("Не смогли удалить %s: %s", path, e)
+        active_temp_files.discard(path)
+    return deleted
+
+
+async def maintenance_loop():
+    """
+    Одна фоновая задача и один таймер на обе уборки: контексты — раз в
+    CACHE_CHECK_INTERVAL, временные файлы — раз в TEMP_FILE_RETENTION.
+    Ждём shutdown_event, а не голый sleep — остановка прерывает паузу сразу.
+    """
+    tick = min(config.CACHE_CHECK_INTERVAL, config.TEMP_FILE_RETENTION)
+    now = time.monotonic()
+    next_contexts = now + config.CACHE_CHECK_INTERVAL
+    next_temp = now + config.TEMP_FILE_RETENTION
+
+    while not is_shutting_down:
+        try:
+            await asyncio.wait_for(shutdown_event.wait(), timeout=tick)
+            break
+        except asyncio.TimeoutError:
+            pass
         except asyncio.CancelledError:
             break
-        except Exception as e:
-            logger.error(f"Temp cleanup error: {e}")
+
+        now = time.monotonic()
+        if now >= next_contexts:
+            next_contexts = now + config.CACHE_CHECK_INTERVAL
+            try:
+                await _expire_contexts()
+            except Exception as e:
+                logger.error("Cache cleanup error: %s", e)
+
+        if now >= next_temp:
+            next_temp = now + config.TEMP_FILE_RETENTION
+            if config.CLEANUP_TEMP_FILES:
+                try:
+                    deleted = await asyncio.to_thread(_sweep_temp_files, time.time(), frozenset(active_temp_files))
+                    if deleted:
+                        logger.debug("Cleaned up %s temp files", deleted)
+                except Exception as e:
+                    logger.error("Temp cleanup error: %s", e)
+
+
+def _truncate(text: str, limit: int, suffix: str = "…") -> str:
+    """Укладывает текст в limit символов вместе с suffix; короткий возвращается без среза."""
+    return text if len(text) <= limit else text[:limit - len(suffix)] + suffix
+
+
+_HDR_RECOGNIZED = "✅ <b>Распознанный текст:</b>"
+_HDR_VIDEO_NOTE = "✅ <b>Распознанный текст из кружочка:</b>"
+_HDR_TEXT = "📝 <b>Полученный текст:</b>"
+_HDR_EXTRACTED_FMT = "✅ <b>Извлечённый текст из {}:</b>"
+
+
+def _build_preview_msg(header: str, text: str, available_modes) -> str:
+    """Сообщение с превью текста и выбором режима; превью экранируется — '<' в тексте не ломает HTML."""
+    modes_text = "📝 Как есть, ✨ Красиво, 📊 Саммари" if "summary" in available_modes else "📝 Как есть, ✨ Красиво"
+    return (
+        f"{header}\n\n"
+        f"<i>{html.escape(_truncate(text, config.PREVIEW_LENGTH))}</i>\n\n"
+        f"<b>Доступные режимы:</b> {modes_text}\n"
+        f"<b>Выберите вариант обработки:</b>"
+    )
 
 
 # ============================================================================
 # КЛАВИАТУРЫ
 # ============================================================================
 
+class DialogCB(CallbackData, prefix="dlg"):
+    """callback_data режима вопросов: aiogram сам разбирает её в типизированные поля."""
+    action: str          # "start" | "exit"
+    user_id: int
+    msg_id: int = 0
+
+
+class ProcessCB(CallbackData, prefix="process"):
+    """Первичный выбор режима обработки."""
+    user_id: int
+    mode: str
+    msg_id: int
+
+
+class SwitchCB(CallbackData, prefix="switch"):
+    """Переключение на другой режим уже обработанного текста."""
+    user_id: int
+    mode: str
+    msg_id: int
+
+
+class ExportCB(CallbackData, prefix="export"):
+    """Экспорт в файл; user_id=None — кнопка из create_keyboard, владелец = нажавший."""
+    user_id: Optional[int] = None
+    mode: str
+    msg_id: int
+    fmt: str
+
+
+class ModeCB(CallbackData, prefix="mode"):
+    """Смена режима из create_keyboard; владелец = нажавший."""
+    mode: str
+    msg_id: int
+
+
+class BreakdownCB(CallbackData, prefix="breakdown"):
+    """«Работа над ошибками» для текущего режима."""
+    msg_id: int
+
+
+class TranslateCB(CallbackData, prefix="tr"):
+    """Перевод на русский и возврат к оригиналу."""
+    action: str          # "to" | "back"
+    user_id: int
+    msg_id: int
+
+
+class FilenameCB(CallbackData, prefix="fname"):
+    """Кнопки под запросом имени файла."""
+    action: str          # "noname" | "cancel"
+    token: str
+
+
+# prefix callback_data → (фабрика, {action: обработчик}); у фабрик без action ключ — None.
+# Один хэндлер на все callback'и: вместо unpack() каждой фабрикой по очереди —
+# один split по префиксу и поиск в словаре
+_CALLBACK_ROUTES: Dict[str, tuple] = {}
+
+
+def _route_callback(factory: type, action: Optional[str] = None):
+    """Регистрирует обработчик callback'а фабрики factory (и её action, если есть) в _CALLBACK_ROUTES."""
+    def decorator(handler):
+        _, handlers = _CALLBACK_ROUTES.setdefault(factory.__prefix__, (factory, {}))
+        handlers[action] = handler
+        return handler
+    return decorator
+
+
+@dp.callback_query()
+async def callback_router(callback: types.CallbackQuery):
+    data = callback.data or ""
+    route = _CALLBACK_ROUTES.get(data.split(":", 1)[0])
+    handler = callback_data = None
+    if route is not None:
+        factory, handlers = route
+        try:
+            callback_data = factory.unpack(data)
+        except (TypeError, ValueError) as e:
+            logger.debug("bad callback_data %r: %s", data, e)
+        else:
+            handler = handlers.get(getattr(callback_data, "action", None))
+    if handler is None:
+        # Кнопки старого формата (process_…, export_…) живут в чатах — снимаем «часики»
+        await callback.answer("Кнопка устарела", show_alert=False)
+        return
+    await handler(callback, callback_data)
+
+
+@functools.lru_cache(maxsize=4096)
 def create_dialog_keyboard(user_id: int) -> InlineKeyboardMarkup:
+    """Кнопка выхода из диалога. Кэшируется: стриминг дёргает её на каждой правке."""
     builder = InlineKeyboardBuilder()
-    builder.row(InlineKeyboardButton(text="🚪 Выйти из режима вопросов", callback_data=f"dialog_exit_{user_id}"))
+    builder.row(InlineKeyboardButton(text="🚪 Выйти из режима вопросов", callback_data=DialogCB(action="exit", user_id=user_id).pack()))
     return builder.as_markup()
 
 
+@functools.lru_cache(maxsize=4096)
+def _ask_question_button(user_id: int, msg_id: int) -> InlineKeyboardButton:
+    """Кнопка «Задать вопрос»: собирается один раз на (user_id, msg_id)."""
+    return InlineKeyboardButton(
+        text="💬 Задать вопрос по тексту",
+        callback_data=DialogCB(action="start", user_id=user_id, msg_id=msg_id).pack()
+    )
+
+
 def create_keyboard(msg_id: int, current_mode: str, available_modes: list = None) -> InlineKeyboardMarkup:
     """Клавиатура после обработки. Кнопка 'Задать вопрос' только в режиме summary."""
+    return _keyboard_markup(msg_id, current_mode, tuple(available_modes or ("basic", "premium")))
+
+
+@functools.lru_cache(maxsize=4096)
+def _keyboard_markup(msg_id: int, current_mode: str, available_modes: tuple) -> InlineKeyboardMarkup:
+    """Меняется только при смене режима — повторные вызовы отдают готовую разметку."""
     builder = InlineKeyboardBuilder()
-    if available_modes is None:
-        available_modes = ["basic", "premium"]
-
-    mode_display = {"basic": "📝 Как есть", "premium": "✨ Красиво", "summary": "📊 Саммари"}
-    mode_buttons = []
-    for mode_code in available_modes:
-        if mode_code in mode_display:
-            prefix = "✅ " if mode_code == current_mode else ""
-            mode_buttons.append(InlineKeyboardButton(
-                text=f"{prefix}{mode_display[mode_code]}",
-                callback_data=f"mode_{mode_code}_{msg_id}"
-            ))
+    mode_buttons = [
+        InlineKeyboardButton(
+            text=("✅ " if mode_code == current_mode else "") + _MODE_LABELS[mode_code],
+            callback_data=ModeCB(mode=mode_code, msg_id=msg_id).pack()
+        )
+        for mode_code in available_modes if mode_code in _MODE_LABELS
+    ]
 
     for i in range(0, len(mode_buttons), 2):
-        if i + 1 < len(mode_buttons):
-            builder.row(mode_buttons[i], mode_buttons[i + 1])
-        else:
-            builder.row(mode_buttons[i])
+        builder.row(*mode_buttons[i:i + 2])
 
     if current_mode and current_mode in ("basic", "premium"):
         builder.row(
-            InlineKeyboardButton(text="✏️ Работа над ошибками", callback_data=f"breakdown_{msg_id}")
+            InlineKeyboardButton(text="✏️ Работа над ошибками", callback_data=BreakdownCB(msg_id=msg_id).pack())
         )
 
     if current_mode:
-        builder.row(
-            InlineKeyboardButton(text="📄 TXT", callback_data=f"export_{current_mode}_{msg_id}_txt"),
-            InlineKeyboardButton(text="📊 PDF", callback_data=f"export_{current_mode}_{msg_id}_pdf"),
-            InlineKeyboardButton(text="📝 DOCX", callback_data=f"export_{current_mode}_{msg_id}_docx"),
-        )
+        builder.row(*(
+            InlineKeyboardButton(text=label, callback_data=ExportCB(mode=current_mode, msg_id=msg_id, fmt=fmt).pack())
+            for label, fmt in _EXPORT_FORMATS
+        ))
 
     return builder.as_markup()
 
 
-def create_options_keyboard(user_id: int, msg_id: int) -> InlineKeyboardMarkup:
-    """Первичный выбор режима. Кнопка 'Задать вопрос' НЕ показывается здесь."""
+# Шаблоны кнопок: меняются только user_id / msg_id
+_MODE_LABELS = {"basic": "📝 Как есть", "premium": "✨ Красиво", "summary": "📊 Саммари"}
+_OPTION_MODES = ("basic", "premium")
+_EXPORT_FORMATS = (("📄 TXT", "txt"), ("📊 PDF", "pdf"), ("📝 DOCX", "docx"))
+
+
+@functools.lru_cache(maxsize=4096)
+def _options_markup(user_id: int, msg_id: int, with_summary: bool) -> InlineKeyboardMarkup:
     builder = InlineKeyboardBuilder()
-    builder.row(
-        InlineKeyboardButton(text="📝 Как есть", callback_data=f"process_{user_id}_basic_{msg_id}"),
-        InlineKeyboardButton(text="✨ Красиво", callback_data=f"process_{user_id}_premium_{msg_id}"),
-    )
-    ctx_data = user_context.get(user_id, {}).get(msg_id)
-    if ctx_data and "summary" in ctx_data.get("available_modes", []):
-        builder.row(InlineKeyboardButton(text="📊 Саммари", callback_data=f"process_{user_id}_summary_{msg_id}"))
+    builder.row(*(
+        InlineKeyboardButton(text=_MODE_LABELS[mode], callback_data=ProcessCB(user_id=user_id, mode=mode, msg_id=msg_id).pack())
+        for mode in _OPTION_MODES
+    ))
+    if with_summary:
+        builder.row(InlineKeyboardButton(text=_MODE_LABELS["summary"], callback_data=ProcessCB(user_id=user_id, mode="summary", msg_id=msg_id).pack()))
     return builder.as_markup()
 
 
-def create_switch_keyboard(user_id: int, msg_id: int) -> Optional[InlineKeyboardMarkup]:
-    """Клавиатура переключения. Кнопка 'Задать вопрос' только если текущий режим — summary."""
-    ctx_data = user_context.get(user_id, {}).get(msg_id)
-    if not ctx_data:
-        return None
+def create_options_keyboard(user_id: int, msg_id: int) -> InlineKeyboardMarkup:
+    """Первичный выбор режима. Кнопка 'Задать вопрос' НЕ показывается здесь."""
+    ctx_data = get_ctx(user_id, msg_id)
+    with_summary = bool(ctx_data and "summary" in ctx_data.get("available_modes", []))
+    return _options_markup(user_id, msg_id, with_summary)
 
-    current = ctx_data.get("mode", "basic")
-    available = ctx_data.get("available_modes", ["basic", "premium"])
+
+@functools.lru_cache(maxsize=4096)
+def _switch_markup(
+    user_id: int,
+    msg_id: int,
+    current: str,
+    available: tuple,
+    with_question: bool,
+    translated: Optional[bool],
+) -> InlineKeyboardMarkup:
+    """Готовая клавиатура переключения; translated=None — кнопки перевода нет."""
     builder = InlineKeyboardBuilder()
 
-    mode_display = {"basic": "📝 Как есть", "premium": "✨ Красиво", "summary": "📊 Саммари"}
     mode_buttons = [
-        InlineKeyboardButton(text=mode_display.get(m, m), callback_data=f"switch_{user_id}_{m}_{msg_id}")
+        InlineKeyboardButton(text=_MODE_LABELS.get(m, m), callback_data=SwitchCB(user_id=user_id, mode=m, msg_id=msg_id).pack())
         for m in available if m != current
     ]
     for i in range(0, len(mode_buttons), 2):
-        if i + 1 < len(mode_buttons):
-            builder.row(mode_buttons[i], mode_buttons[i + 1])
-        else:
-            builder.row(mode_buttons[i])
+        builder.row(*mode_buttons[i:i + 2])
 
     # Кнопка "Задать вопрос" — только в режиме саммари
-    if current == "summary" and len(ctx_data.get("original", "")) > 100:
-        builder.row(InlineKeyboardButton(
-            text="💬 Задать вопрос по тексту",
-            callback_data=f"dialog_start_{user_id}_{msg_id}"
-        ))
+    if with_question:
+        builder.row(_ask_question_button(user_id, msg_id))
 
     # Кнопка "Работа над ошибками" — только для basic и premium
     if current in ("basic", "premium"):
         builder.row(InlineKeyboardButton(
             text="✏️ Работа над ошибками",
-            callback_data=f"breakdown_{msg_id}"
+            callback_data=BreakdownCB(msg_id=msg_id).pack()
         ))
 
     # Кнопка перевода — если оригинал не на русском
-    original = ctx_data.get("original", "")
-    if original and processors.is_non_russian(original):
-        if ctx_data.get("is_translated", False):
-            builder.row(InlineKeyboardButton(
-                text="↩️ Оригинал",
-                callback_data=f"translate_back_{user_id}_{msg_id}"
-            ))
-        else:
-            builder.row(InlineKeyboardButton(
-                text="🌐 Перевести на русский",
-                callback_data=f"translate_{user_id}_{msg_id}"
-            ))
+    if translated is True:
+        builder.row(InlineKeyboardButton(
+            text="↩️ Оригинал",
+            callback_data=TranslateCB(action="back", user_id=user_id, msg_id=msg_id).pack()
+        ))
+    elif translated is False:
+        builder.row(InlineKeyboardButton(
+            text="🌐 Перевести на русский",
+            callback_data=TranslateCB(action="to", user_id=user_id, msg_id=msg_id).pack()
+        ))
 
     if current:
-        builder.row(
-            InlineKeyboardButton(text="📄 TXT", callback_data=f"export_{user_id}_{current}_{msg_id}_txt"),
-            InlineKeyboardButton(text="📊 PDF", callback_data=f"export_{user_id}_{current}_{msg_id}_pdf"),
-            InlineKeyboardButton(text="📝 DOCX", callback_data=f"export_{user_id}_{current}_{msg_id}_docx"),
-        )
+        builder.row(*(
+            InlineKeyboardButton(text=label, callback_data=ExportCB(user_id=user_id, mode=current, msg_id=msg_id, fmt=fmt).pack())
+            for label, fmt in _EXPORT_FORMATS
+        ))
 
     return builder.as_markup()
 
 
+def create_switch_keyboard(user_id: int, msg_id: int) -> Optional[InlineKeyboardMarkup]:
+    """Клавиатура переключения. Кнопка 'Задать вопрос' только если текущий режим — summary."""
+    ctx_data = get_ctx(user_id, msg_id)
+    if not ctx_data:
+        return None
+
+    current = ctx_data.get("mode", "basic")
+    available = tuple(ctx_data.get("available_modes", ["basic", "premium"]))
+    original = ctx_data.get("original", "")
+
+    # langdetect на каждое нажатие дорог — язык оригинала определяем один раз на запись
+    if "non_russian" not in ctx_data:
+        ctx_data["non_russian"] = bool(original) and processors.is_non_russian(original)
+    translated = ctx_data.get("is_translated", False) if ctx_data["non_russian"] else None
+
+    return _switch_markup(
+        user_id, msg_id, current, available,
+        current == "summary" and ctx_data.get("has_question_btn", False),
+        translated,
+    )
+
+
 # ============================================================================
 # СОХРАНЕНИЕ ФАЙЛОВ
 # ============================================================================
 
+# Шарды экспорта, которые уже созданы этим процессом: makedirs только при первом экспорте в шард
+_export_shards_ready: set = set()
+
+
 async def save_to_file(
     user_id: int,
     text: str,
@@ -909,108 +1473,242 @@ async def save_to_file(
     custom_name: Optional[str] = None,
 ) -> Optional[str]:
     """
-    Сохраняет text в файл выбранного формата и возвращает путь.
+    Сохраняет text в PDF или DOCX и возвращает путь; None — файл собрать не удалось.
+    TXT на диск не пишется: _do_export отдаёт его из памяти.
 
     Имя строится через build_export_filename:
       [custom__]<mode>_<user_id>_<timestamp>.<ext>
 
     user_id + timestamp в имени гарантируют уникальность при параллельных
-    экспортах в общем /tmp.
+    экспортах; файл кладётся в подкаталог EXPORT_DIR по user_id % 256.
     """
     filename = build_export_filename(user_id, mode, custom_name)
-
-    if format_type == "txt":
-        filepath = f"{config.TEMP_DIR}/{filename}.txt"
-        if await processors.save_to_txt(text, filepath):
+    shard = user_id % 256
+    export_dir = os.path.join(config.EXPORT_DIR, f"{shard:02x}")
+    if shard not in _export_shards_ready:
+        await asyncio.to_thread(os.makedirs, export_dir, exist_ok=True)
+        _export_shards_ready.add(shard)
+
+    if format_type == "pdf":
+        filepath = f"{export_dir}/{filename}.pdf"
+        if await processors.save_to_pdf(text, filepath):
             return filepath
 
-    elif format_type == "pdf":
-        filepath = f"{config.TEMP_DIR}/{filename}.pdf"
-        if await processors.save_to_pdf(text, filepath):
+    elif format_type == "docx":
+        filepath = f"{export_dir}/{filename}.docx"
+        if await processors.save_to_docx(text, filepath):
             return filepath
-        # fallback на txt
-        filepath_txt = f"{config.TEMP_DIR}/{filename}.txt"
-        if await processors.save_to_txt(text, filepath_txt):
-            return filepath_txt
 
-    elif format_type == "docx":
-        filepath = f"{config.TEMP_DIR}/{filename}.docx"
-        if await processors.save_to_docx(text, filepath):
-            return filepath
-        # fallback на txt
-        filepath_txt = f"{config.TEMP_DIR}/{filename}.txt"
-        if await processors.save_to_txt(text, filepath_txt):
-            return filepath_txt
+    # Шард могли удалить снаружи (чистка /tmp) — в следующий раз создадим заново
+    _export_shards_ready.discard(shard)
+    return None
+
+
+# ============================================================================
+# СТРИМИНГ (ДИАЛОГ)
+# ============================================================================
+
+def _fit_telegram(text: str) -> str:
+    """Страховка от лимита Telegram в 4096 символов на сообщение."""
+    return _truncate(text, 4096)
+
+
+def _stream_text(state: Dict[str, Any]) -> str:
+    """Склеивает накопленные чанки; склейка остаётся единственным элементом буфера."""
+    parts = state["parts"]
+    if len(parts) > 1:
+        parts[:] = ["".join(parts)]
+    return parts[0] if parts else ""
+
+
+def _stream_cut(text: str, offset: int) -> int:
+    """Где закончить текущее сообщение стрима: по последнему переносу строки в окне, иначе ровно по лимиту."""
+    limit = offset + config.STREAM_MESSAGE_LIMIT
+    cut = text.rfind("\n", offset + config.STREAM_MESSAGE_LIMIT // 2, limit)
+    return cut + 1 if cut != -1 else limit
+
+
+async def _roll_stream_message(message: types.Message, state: Dict[str, Any]):
+    """
+    Закрывает заполненное сообщение стрима и открывает следующее.
+    Ответ не обрезается: длинный ответ уходит несколькими сообщениями.
+    """
+    text = _stream_text(state)
+    end = _stream_cut(text, state["offset"])
+    part = _fit_telegram(sanitize_llm_output(text[state["offset"]:end]))
+    for _ in range(2):
+        try:
+            await state["placeholder"].edit_text(part)
+            break
+        except TelegramRetryAfter as e:
+            logger.debug("stream roll flood control, retry after %ss", e.retry_after)
+            await asyncio.sleep(e.retry_after)
+        except Exception as e:
+            logger.debug("stream roll edit_text failed: %s", e)
+            break
+    # Сдвигаем offset только когда новое сообщение уже есть — иначе финальная правка
+    # перепишет хвостом заполненное старое
+    placeholder = await message.answer("💭 ...")
+    state["offset"] = end
+    state["last_sent"] = ""
+    state["placeholder"] = placeholder
+
+
+async def _safe_edit(placeholder: types.Message, text: str, reply_markup=None, **kwargs) -> bool:
+    """
+    edit_text, для которого «message is not modified» — не ошибка, а просто False.
+    TelegramRetryAfter пробрасывается: реакция на flood control — дело вызывающего.
+    """
+    try:
+        await placeholder.edit_text(text, reply_markup=reply_markup, **kwargs)
+        return True
+    except TelegramBadRequest as e:
+        if "message is not modified" in str(e):
+            return False
+        raise
+
+
+async def _sleep_unless(stop: asyncio.Event, delay: float):
+    """Пауза, которую stop прерывает сразу."""
+    try:
+        await asyncio.wait_for(stop.wait(), timeout=delay)
+    except asyncio.TimeoutError:
+        pass
+
 
-    return None
+async def _stream_editor(
+    message: types.Message,
+    state: Dict[str, Any],
+    changed: asyncio.Event,
+    stop: asyncio.Event,
+    reply_markup,
+):
+    """
+    Фоновый редактор стрим-сообщения.
+
+    Берёт только последний снимок ответа — промежуточные чанки,
+    пришедшие пока Telegram отвечал, схлопываются в одну правку.
+    Не блокирует приём чанков от Groq. Когда текущее сообщение заполнено,
+    переходит к новому (см. _roll_stream_message).
+    Останавливается по stop, а не отменой: начатая правка или перенос
+    на новое сообщение доходят до конца, state остаётся согласованным.
+    """
+    loop = asyncio.get_running_loop()
+    last_edit_length = 0
+    interval = config.STREAM_EDIT_INTERVAL
+    while not stop.is_set():
+        await changed.wait()
+        changed.clear()
+        if stop.is_set():
+            return
+        if state["length"] - last_edit_length < config.STREAM_EDIT_MIN_DELTA:
+            continue
 
+        while state["length"] - state["offset"] > config.STREAM_MESSAGE_LIMIT and not stop.is_set():
+            await _roll_stream_message(message, state)
+        if stop.is_set():
+            return
+
+        text = _stream_text(state)
+        display = text[state["offset"]:] + "▌"
+        if display != state["last_sent"]:
+            try:
+                if await _safe_edit(state["placeholder"], display, reply_markup):
+                    state["last_sent"] = display
+            except TelegramRetryAfter as e:
+                state["retry_until"] = loop.time() + e.retry_after
+                # Раз Telegram уже притормозил нас — до конца ответа правим вдвое реже
+                interval *= 2
+                logger.debug("streaming edit flood control, retry after %ss, interval %ss", e.retry_after, interval)
+                await _sleep_unless(stop, e.retry_after)
+            except Exception as e:
+                logger.debug("streaming edit_text skipped: %s", e)
+        last_edit_length = len(text)
+        # Правим по времени, а не по каждым N символам: иначе быстрый стрим ловит 429
+        await _sleep_unless(stop, interval)
 
-# ============================================================================
-# СТРИМИНГ (ДИАЛОГ)
-# ============================================================================
 
 async def handle_streaming_answer(message: types.Message, user_id: int, msg_id: int, question: str):
+    # Предусловия — до плейсхолдера: ошибка обходится одним сообщением без лишней правки
+    if is_shutting_down:
+        await message.answer("🛑 Бот останавливается.")
+        return
+    if not groq_clients:
+        await message.answer("❌ Нет доступных Groq клиентов")
+        return
+    ctx = await fetch_ctx(user_id, msg_id)
+    if not ctx:
+        active_dialogs.pop(user_id, None)
+        await message.answer("❌ Документ не найден. Начните заново.")
+        return
+    doc_text = ctx.get("original", "")
+    if not doc_text:
+        await message.answer("❌ Текст документа пуст")
+        return
+
     placeholder = await message.answer("💭 Думаю...")
-    accumulated = ""
-    last_edit_length = 0
+    loop = asyncio.get_running_loop()
+    # parts/length — чанки ответа и их суммарная длина (склеиваем только перед правкой);
+    # offset — с какого символа начинается текущее сообщение;
+    # placeholder — сообщение, которое сейчас правим; last_sent — что в нём реально видно;
+    # retry_until — до этого момента Telegram просил не трогать сообщение (flood control)
+    state: Dict[str, Any] = {
+        "parts": [], "length": 0, "offset": 0, "placeholder": placeholder,
+        "last_sent": "", "retry_until": 0.0,
+    }
+    changed = asyncio.Event()
+    stop = asyncio.Event()
+    editor_task: Optional[asyncio.Task] = None
 
     try:
-        if is_shutting_down:
-            await placeholder.edit_text("🛑 Бот останавливается.")
-            return
-        if not groq_clients:
-            await placeholder.edit_text("❌ Нет доступных Groq клиентов")
-            return
-        if user_id not in user_context or msg_id not in user_context[user_id]:
-            await placeholder.edit_text("❌ Документ не найден. Начните заново.")
-            active_dialogs.pop(user_id, None)
-            return
-
-        doc_text = user_context[user_id][msg_id].get("original", "")
-        if not doc_text:
-            await placeholder.edit_text("❌ Текст документа пуст")
-            return
+        processors.document_dialogues.setdefault(user_id, {})[msg_id] = {"text": doc_text, "history": []}
 
-        if not hasattr(processors, 'document_dialogues'):
-            processors.document_dialogues = {}
-        if user_id not in processors.document_dialogues:
-            processors.document_dialogues[user_id] = {}
-        processors.document_dialogues[user_id][msg_id] = {"text": doc_text, "history": []}
+        keyboard = create_dialog_keyboard(user_id)
+        editor_task = asyncio.create_task(_stream_editor(message, state, changed, stop, keyboard))
 
         async for chunk in processors.stream_document_answer(user_id, msg_id, question, groq_clients):
             if chunk and not is_shutting_down:
-                accumulated += chunk
-                if len(accumulated) - last_edit_length > 30:
-                    try:
-                        display = accumulated + "▌"
-                        if len(display) > 4096:
-                            display = display[:4093] + "..."
-                        await placeholder.edit_text(display, reply_markup=create_dialog_keyboard(user_id))
-                    except Exception as e:
-                        # типичный кейс — "message is not modified"
-                        logger.debug(f"streaming edit_text skipped: {e}")
-                    last_edit_length = len(accumulated)
+                state["parts"].append(chunk)
+                state["length"] += len(chunk)
+                changed.set()
+
+        # Не cancel: даём редактору закончить начатую правку/перенос и выйти самому
+        stop.set()
+        changed.set()
+        await editor_task
 
         if is_shutting_down:
             return
 
-        final = sanitize_llm_output(accumulated) if accumulated else "❌ Пустой ответ"
-        if len(final) > 4096:
-            final = final[:4093] + "..."
-        await placeholder.edit_text(final, parse_mode="HTML", reply_markup=create_dialog_keyboard(user_id))
+        # Хвост, который редактор не успел разложить по сообщениям
+        while state["length"] - state["offset"] > config.STREAM_MESSAGE_LIMIT:
+            await _roll_stream_message(message, state)
+
+        tail = _stream_text(state)[state["offset"]:]
+        final = _fit_telegram(sanitize_llm_output(tail)) if state["length"] else "❌ Пустой ответ"
+        if final == state["last_sent"]:
+            return
+        # Финальную правку делаем всегда, но после окна flood control
+        wait = state["retry_until"] - loop.time()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        await state["placeholder"].edit_text(final, reply_markup=keyboard)
 
     except asyncio.CancelledError:
         try:
-            await placeholder.edit_text("🛑 Генерация прервана.")
+            await state["placeholder"].edit_text("🛑 Генерация прервана.")
         except Exception as e:
-            logger.debug(f"placeholder edit on cancel failed: {e}")
+            logger.debug("placeholder edit on cancel failed: %s", e)
     except Exception as e:
-        logger.error(f"Streaming error: {e}", exc_info=True)
+        logger.error("Streaming error: %s", e, exc_info=True)
         if not is_shutting_down:
             try:
-                await placeholder.edit_text(f"❌ Ошибка при генерации: {str(e)[:200]}")
+                await state["placeholder"].edit_text(f"❌ Ошибка при генерации: {str(e)[:200]}")
             except Exception as edit_err:
-                logger.debug(f"error placeholder edit failed: {edit_err}")
+                logger.debug("error placeholder edit failed: %s", edit_err)
+    finally:
+        if editor_task and not editor_task.done():
+            editor_task.cancel()
 
 
 # ============================================================================
@@ -1041,20 +1739,75 @@ async def _bg_save_transcript(user_id: int, source_type: str, original_text: str
     )
     transcript_id = await database.save_transcript(user_id, source_type, sanitize_for_db(original_text))
     # Сохраняем transcript_id в контекст для последующего сохранения результатов
-    if transcript_id and user_id in user_context and msg_id in user_context[user_id]:
-        user_context[user_id][msg_id]["transcript_id"] = transcript_id
-    logger.debug(f"💾 БД: transcript_id={transcript_id} для user={user_id}")
+    ctx = get_ctx(user_id, msg_id)
+    if transcript_id and ctx:
+        ctx["transcript_id"] = transcript_id
+    logger.debug("💾 БД: transcript_id=%s для user=%s", transcript_id, user_id)
+
+
+def _prefetch_file(file_id: str) -> asyncio.Task:
+    """get_file уходит сразу, параллельно с сообщением «обрабатываю…» — минус один последовательный запрос."""
+    return asyncio.create_task(bot.get_file(file_id))
+
+
+async def _download_to_temp(file_path: str, name: str) -> str:
+    """Качает файл Telegram сразу на диск — без BytesIO и копии через getvalue()."""
+    tmp_path = os.path.join(config.TEMP_DIR, name)
+    active_temp_files.add(tmp_path)
+    try:
+        await bot.download_file(file_path, destination=tmp_path)
+    except BaseException:
+        # Недокачанный файл не должен оставаться ни на диске, ни в active_temp_files
+        await _remove_temp(tmp_path)
+        raise
+    return tmp_path
+
+
+async def _download_source(file_info: types.File, name: str, *, in_memory: bool = True) -> processors.FileSource:
+    """Мелкий файл — сразу в память (без записи, чтения и unlink), крупный — на диск, чтобы не держать его в RAM."""
+    if in_memory and file_info.file_size and file_info.file_size <= config.IN_MEMORY_DOWNLOAD_LIMIT:
+        # Сам BytesIO, а не getvalue(): обработчики читают его буфер без копии
+        return await bot.download_file(file_info.file_path)
+    return await _download_to_temp(file_info.file_path, name)
+
+
+async def _release_source(source: processors.FileSource):
+    if isinstance(source, str):
+        await _remove_temp(source)
+
+
+async def _delete_quietly(message: types.Message):
+    """Удаление исходного сообщения — идёт параллельно с финальной правкой статуса."""
+    try:
+        await message.delete()
+    except Exception as e:
+        logger.debug("message.delete() failed: %s", e)
+
+
+async def _remove_temp(path: str):
+    try:
+        await asyncio.to_thread(os.remove, path)
+    except OSError as e:
+        logger.debug("temp cleanup failed: %s", e)
+    finally:
+        active_temp_files.discard(path)
 
 
 # ============================================================================
 # ХЭНДЛЕРЫ БОТА
 # ============================================================================
 
+# Паттерны роутинга ссылок компилируются один раз; match якорится в начале текста,
+# так что обычное сообщение отсекается на первом символе
+_YOUTUBE_URL_RE = re.compile(r'https?://(www\.)?(youtube\.com|youtu\.be)/\S+')
+_URL_RE = re.compile(r'https?://\S+')
+
+
 @dp.message(Command("start"))
 async def start_handler(message: types.Message):
     stats["processed_messages"] += 1
-    await message.answer(config.START_MESSAGE, parse_mode="HTML", reply_markup=ReplyKeyboardRemove())
-    asyncio.create_task(database.upsert_user(
+    await message.answer(config.START_MESSAGE, reply_markup=ReplyKeyboardRemove())
+    _spawn(database.upsert_user(
         message.from_user.id,
         username=message.from_user.username,
         first_name=message.from_user.first_name,
@@ -1064,7 +1817,7 @@ async def start_handler(message: types.Message):
 @dp.message(Command("help"))
 async def help_handler(message: types.Message):
     stats["processed_messages"] += 1
-    await message.answer(config.HELP_MESSAGE, parse_mode="HTML")
+    await message.answer(config.HELP_MESSAGE)
 
 
 @dp.message(Command("status"))
@@ -1072,10 +1825,7 @@ async def status_handler(message: types.Message):
     stats["processed_messages"] += 1
     docx_status = "✅" if processors.DOCX_AVAILABLE else "❌"
     db_status = "✅ Supabase" if database.is_available() else "❌ нет БД"
-    temp_files = len([
-        f for f in os.listdir(config.TEMP_DIR)
-        if f.startswith(('video_', 'audio_', 'text_', 'export_'))
-    ]) if os.path.exists(config.TEMP_DIR) else 0
+    temp_files = len(active_temp_files)
 
     status_text = config.STATUS_MESSAGE.format(
         groq_count=len(groq_clients),
@@ -1086,7 +1836,7 @@ async def status_handler(message: types.Message):
         temp_files=temp_files,
     )
     status_text += f"\n\n💬 Активных диалогов: {len(active_dialogs)}"
-    await message.answer(status_text, parse_mode="HTML")
+    await message.answer(status_text)
 
 
 @dp.message(Command("history"))
@@ -1110,13 +1860,11 @@ async def history_handler(message: types.Message):
     lines = [f"📊 Обработано сообщений: {stats['processed_messages']}\n\n📜 <b>Последние 10 обработок:</b>\n"]
     for i, rec in enumerate(records, 1):
         emoji = source_emoji.get(rec.get("source_type", ""), "📌")
-        preview = (rec.get("original_text") or "")[:80].replace("\n", " ")
-        if len(rec.get("original_text", "")) > 80:
-            preview += "..."
+        preview = _truncate(rec.get("original_text") or "", 80).replace("\n", " ")
         dt = rec.get("created_at", "")[:16].replace("T", " ") if rec.get("created_at") else ""
-        lines.append(f"{i}. {emoji} <i>{preview}</i>\n   <code>{dt}</code>")
+        lines.append(f"{i}. {emoji} <i>{html.escape(preview)}</i>\n   <code>{dt}</code>")
 
-    await message.answer("\n\n".join(lines), parse_mode="HTML")
+    await message.answer("\n\n".join(lines))
 
 
 @dp.message(Command("exit"))
@@ -1134,77 +1882,104 @@ async def exit_dialog_handler(message: types.Message):
 # ГОЛОСОВЫЕ И КРУЖОЧКИ
 # ============================================================================
 
-@dp.message(F.voice)
-async def voice_handler(message: types.Message):
-    if is_shutting_down:
-        await message.answer("🛑 Бот останавливается, попробуйте позже.")
-        return
-
+async def _offer_modes(
+    message: types.Message,
+    msg: types.Message,
+    original_text: str,
+    *,
+    kind: str,
+    header: str,
+    source_type: Optional[str] = None,
+    filename: Optional[str] = None,
+    consumed: Optional[List[types.Message]] = None,
+):
+    """
+    Общий финал всех входящих: контекст, префетч режимов, запись в БД в фоне
+    и правка статуса в превью с выбором режима. consumed — исходные сообщения
+    пользователя, которые удаляются параллельно с правкой.
+    """
     user_id = message.from_user.id
+    available_modes = processors.get_available_modes(original_text)
+    save_to_history(user_id, msg.message_id, original_text, mode="basic", available_modes=available_modes)
+    _schedule_prefetch(user_id, msg.message_id, original_text, available_modes)
+
+    ctx = get_ctx(user_id, msg.message_id)
+    if ctx:
+        ctx["type"] = kind
+        ctx["chat_id"] = message.chat.id
+        if filename:
+            ctx["filename"] = filename
+
+    # Сохраняем в БД в фоне
+    _spawn(_bg_save_transcript(user_id, source_type or kind, original_text, msg.message_id, message))
+
+    await asyncio.gather(
+        msg.edit_text(
+            _build_preview_msg(header, original_text, available_modes),
+            reply_markup=create_options_keyboard(user_id, msg.message_id)
+        ),
+        *(_delete_quietly(m) for m in (consumed or [message])),
+    )
 
-    if user_id in active_dialogs:
-        await message.answer("⏳ Голосовые вопросы пока не поддерживаются. Напишите текст.")
-        return
 
-    if user_id in processing_users:
-        await message.answer(config.ERROR_BUSY)
+async def _reject_oversized(message: types.Message, file_size: Optional[int]) -> bool:
+    """Размер приходит в самом апдейте — отказываем до статуса, get_file и скачивания."""
+    if not file_size:
+        return False
+    if file_size > config.FILE_SIZE_LIMIT:
+        await message.answer(config.ERROR_FILE_TOO_LARGE)
+        return True
+    if file_size > config.TELEGRAM_DOWNLOAD_LIMIT:
+        await message.answer(config.ERROR_TELEGRAM_FILE_TOO_LARGE)
+        return True
+    return False
+
+
+async def _handle_recording(
+    message: types.Message,
+    *,
+    kind: str,
+    file_id: str,
+    file_size: Optional[int],
+    status_text: str,
+    suffix: str,
+    transcribe: Callable[[processors.FileSource], Awaitable[str]],
+    header: str,
+    error_text: str,
+    in_memory: bool = True,
+):
+    """Голосовое, кружочек, аудио: скачать → расшифровать → предложить режимы."""
+    if await _reject_oversized(message, file_size):
         return
 
+    user_id = message.from_user.id
     processing_users.add(user_id)
-    msg = await message.answer(config.MSG_PROCESSING_VOICE)
+    file_task = _prefetch_file(file_id)
+    msg = await message.answer(status_text)
 
     try:
-        file_info = await bot.get_file(message.voice.file_id)
-        voice_buffer = io.BytesIO()
-        await bot.download_file(file_info.file_path, voice_buffer)
-
-        original_text = await processors.transcribe_voice(voice_buffer.getvalue(), groq_clients)
+        file_info = await file_task
+        source = await _download_source(file_info, f"upload_{user_id}_{msg.message_id}{suffix}", in_memory=in_memory)
+        try:
+            original_text = await transcribe(source)
+        finally:
+            await _release_source(source)
 
         if original_text.startswith("❌"):
             await msg.edit_text(original_text)
             return
 
-        available_modes = processors.get_available_modes(original_text)
-        save_to_history(user_id, msg.message_id, original_text, mode="basic", available_modes=available_modes)
-
-        if user_id in user_context and msg.message_id in user_context[user_id]:
-            user_context[user_id][msg.message_id]["type"] = "voice"
-            user_context[user_id][msg.message_id]["chat_id"] = message.chat.id
-
-        # Сохраняем в БД в фоне
-        asyncio.create_task(_bg_save_transcript(user_id, "voice", original_text, msg.message_id, message))
-
-        author = get_author_label(message)
-        preview = original_text[:config.PREVIEW_LENGTH]
-        if len(original_text) > config.PREVIEW_LENGTH:
-            preview += "..."
-
-        modes_text = "📝 Как есть, ✨ Красиво"
-        if "summary" in available_modes:
-            modes_text += ", 📊 Саммари"
-
-        await msg.edit_text(
-            f"{author}✅ <b>Распознанный текст:</b>\n\n"
-            f"<i>{preview}</i>\n\n"
-            f"<b>Доступные режимы:</b> {modes_text}\n"
-            f"<b>Выберите вариант обработки:</b>",
-            parse_mode="HTML",
-            reply_markup=create_options_keyboard(user_id, msg.message_id)
-        )
-        try:
-            await message.delete()
-        except Exception as e:
-            logger.debug(f"message.delete() failed: {e}")
+        await _offer_modes(message, msg, original_text, kind=kind, header=get_author_label(message) + header)
 
     except Exception as e:
-        logger.error(f"Voice handler error: {e}")
-        await msg.edit_text("❌ Ошибка обработки голосового сообщения")
+        logger.error("%s handler error: %s", kind, e)
+        await msg.edit_text(error_text)
     finally:
         processing_users.discard(user_id)
 
 
-@dp.message(F.video_note)
-async def video_note_handler(message: types.Message):
+@dp.message(F.voice)
+async def voice_handler(message: types.Message):
     if is_shutting_down:
         await message.answer("🛑 Бот останавливается, попробуйте позже.")
         return
@@ -1219,56 +1994,60 @@ async def video_note_handler(message: types.Message):
         await message.answer(config.ERROR_BUSY)
         return
 
-    processing_users.add(user_id)
-    msg = await message.answer("🎥 Обрабатываю кружочек...")
-
-    try:
-        file_info = await bot.get_file(message.video_note.file_id)
-        buffer = io.BytesIO()
-        await bot.download_file(file_info.file_path, buffer)
-
-        original_text = await processors.process_video_file(buffer.getvalue(), "video_note.mp4", groq_clients, with_timecodes=False)
+    await _handle_recording(
+        message,
+        kind="voice",
+        file_id=message.voice.file_id,
+        file_size=message.voice.file_size,
+        status_text=config.MSG_PROCESSING_VOICE,
+        suffix=".ogg",
+        transcribe=lambda source: processors.transcribe_voice(source, groq_clients),
+        header=_HDR_RECOGNIZED,
+        error_text="❌ Ошибка обработки голосового сообщения",
+    )
 
-        if original_text.startswith("❌"):
-            await msg.edit_text(original_text)
-            return
 
-        available_modes = processors.get_available_modes(original_text)
-        save_to_history(user_id, msg.message_id, original_text, mode="basic", available_modes=available_modes)
+async def _transcribe_video_note(source: processors.FileSource) -> str:
+    # mp3 рядом с видео создаёт и удаляет processors — держим его в active_temp_files, чтобы не снесла уборка
+    audio_path = processors.video_audio_path(source) if isinstance(source, str) else None
+    if audio_path:
+        active_temp_files.add(audio_path)
+    try:
+        return await processors.process_video_file(source, "video_note.mp4", groq_clients, with_timecodes=False)
+    finally:
+        if audio_path:
+            active_temp_files.discard(audio_path)
 
-        if user_id in user_context and msg.message_id in user_context[user_id]:
-            user_context[user_id][msg.message_id]["type"] = "video_note"
-            user_context[user_id][msg.message_id]["chat_id"] = message.chat.id
 
-        asyncio.create_task(_bg_save_transcript(user_id, "video_note", original_text, msg.message_id, message))
+@dp.message(F.video_note)
+async def video_note_handler(message: types.Message):
+    if is_shutting_down:
+        await message.answer("🛑 Бот останавливается, попробуйте позже.")
+        return
 
-        author = get_author_label(message)
-        preview = original_text[:config.PREVIEW_LENGTH]
-        if len(original_text) > config.PREVIEW_LENGTH:
-            preview += "..."
+    user_id = message.from_user.id
 
-        modes_text = "📝 Как есть, ✨ Красиво"
-        if "summary" in available_modes:
-            modes_text += ", 📊 Саммари"
+    if user_id in active_dialogs:
+        await message.answer("⏳ Голосовые вопросы пока не поддерживаются. Напишите текст.")
+        return
 
-        await msg.edit_text(
-            f"{author}✅ <b>Распознанный текст из кружочка:</b>\n\n"
-            f"<i>{preview}</i>\n\n"
-            f"<b>Доступные режимы:</b> {modes_text}\n"
-            f"<b>Выберите вариант обработки:</b>",
-            parse_mode="HTML",
-            reply_markup=create_options_keyboard(user_id, msg.message_id)
-        )
-        try:
-            await message.delete()
-        except Exception as e:
-            logger.debug(f"message.delete() failed: {e}")
+    if user_id in processing_users:
+        await message.answer(config.ERROR_BUSY)
+        return
 
-    except Exception as e:
-        logger.error(f"Video note handler error: {e}")
-        await msg.edit_text("❌ Ошибка обработки кружочка")
-    finally:
-        processing_users.discard(user_id)
+    await _handle_recording(
+        message,
+        kind="video_note",
+        file_id=message.video_note.file_id,
+        file_size=message.video_note.file_size,
+        status_text="🎥 Обрабатываю кружочек...",
+        suffix=".mp4",
+        transcribe=_transcribe_video_note,
+        header=_HDR_VIDEO_NOTE,
+        error_text="❌ Ошибка обработки кружочка",
+        # ffmpeg читает только с диска — в память качать незачем
+        in_memory=False,
+    )
 
 
 @dp.message(F.audio)
@@ -1284,59 +2063,20 @@ async def audio_handler(message: types.Message):
         await message.answer(config.ERROR_BUSY)
         return
 
-    processing_users.add(user_id)
-    msg = await message.answer(config.MSG_TRANSCRIBING)
-
-    try:
-        file_info = await bot.get_file(message.audio.file_id)
-        audio_buffer = io.BytesIO()
-        await bot.download_file(file_info.file_path, audio_buffer)
-
-        original_text = await processors.transcribe_voice(audio_buffer.getvalue(), groq_clients)
-
-        if original_text.startswith("❌"):
-            await msg.edit_text(original_text)
-            return
-
-        available_modes = processors.get_available_modes(original_text)
-        save_to_history(user_id, msg.message_id, original_text, mode="basic", available_modes=available_modes)
-
-        if user_id in user_context and msg.message_id in user_context[user_id]:
-            user_context[user_id][msg.message_id]["type"] = "audio"
-            user_context[user_id][msg.message_id]["chat_id"] = message.chat.id
-
-        asyncio.create_task(_bg_save_transcript(user_id, "audio", original_text, msg.message_id, message))
-
-        author = get_author_label(message)
-        preview = original_text[:config.PREVIEW_LENGTH]
-        if len(original_text) > config.PREVIEW_LENGTH:
-            preview += "..."
-
-        modes_text = "📝 Как есть, ✨ Красиво"
-        if "summary" in available_modes:
-            modes_text += ", 📊 Саммари"
-
-        await msg.edit_text(
-            f"{author}✅ <b>Распознанный текст:</b>\n\n"
-            f"<i>{preview}</i>\n\n"
-            f"<b>Доступные режимы:</b> {modes_text}\n"
-            f"<b>Выберите вариант обработки:</b>",
-            parse_mode="HTML",
-            reply_markup=create_options_keyboard(user_id, msg.message_id)
-        )
-        try:
-            await message.delete()
-        except Exception as e:
-            logger.debug(f"message.delete() failed: {e}")
-
-    except Exception as e:
-        logger.error(f"Audio handler error: {e}")
-        await msg.edit_text("❌ Ошибка обработки аудиофайла")
-    finally:
-        processing_users.discard(user_id)
+    await _handle_recording(
+        message,
+        kind="audio",
+        file_id=message.audio.file_id,
+        file_size=message.audio.file_size,
+        status_text=config.MSG_TRANSCRIBING,
+        suffix="",
+        transcribe=lambda source: processors.transcribe_voice(source, groq_clients),
+        header=_HDR_RECOGNIZED,
+        error_text="❌ Ошибка обработки аудиофайла",
+    )
 
 
-@dp.message(F.text.regexp(r'https?://(www\.)?(youtube\.com|youtu\.be)/\S+'))
+@dp.message(F.text.regexp(_YOUTUBE_URL_RE))
 async def youtube_handler(message: types.Message):
     """Обработка YouTube-ссылок: субтитры → диалог + саммари."""
     if is_shutting_down:
@@ -1392,7 +2132,7 @@ async def youtube_handler(message: types.Message):
             timecoded_text = fmt_result["timecoded"]
             fmt_source = fmt_result["source"]
 
-        logger.info(f"YouTube {video_id}: subs={subs_source}, fmt={fmt_source}")
+        logger.info("YouTube %s: subs=%s, fmt=%s", video_id, subs_source, fmt_source)
 
         # Саммари
         await msg.edit_text("📊 Делаю саммари...")
@@ -1404,45 +2144,44 @@ async def youtube_handler(message: types.Message):
         available_modes = ["basic", "premium", "summary"]
         save_to_history(user_id, msg.message_id, dialogue_text, mode="summary", available_modes=available_modes)
 
-        if user_id in user_context and msg.message_id in user_context[user_id]:
-            ctx = user_context[user_id][msg.message_id]
+        ctx = get_ctx(user_id, msg.message_id)
+        if ctx:
             ctx["type"] = "youtube"
             ctx["chat_id"] = message.chat.id
             ctx["original"] = dialogue_text
             ctx["timecoded"] = timecoded_text   # сырой с таймкодами, для экспорта
-            ctx["cached_results"]["summary"] = summary
+            # В cached_results всё хранится уже санитизированным — как и результаты режимов
+            ctx["cached_results"]["summary"] = sanitize_llm_output(summary)
             ctx["yt_lang"] = lang
             ctx["yt_url"] = url
             schedule_persist(user_id, msg.message_id)
 
-        asyncio.create_task(_bg_save_transcript(user_id, "youtube", dialogue_text, msg.message_id, message))
+        _spawn(_bg_save_transcript(user_id, "youtube", dialogue_text, msg.message_id, message))
 
         lang_flag = "🇷🇺" if lang == "ru" else "🌐"
         # Иконка источника: 💾 память, 🗄️ БД, 🌐 свежая загрузка
         cache_icon = {"memory": "💾", "supabase": "🗄️"}.get(subs_source, "🌐")
-        display = summary if len(summary) <= 4000 else summary[:3997] + "..."
-
-        await msg.edit_text(
-            f"📺 <b>YouTube</b> {lang_flag} {cache_icon}\n"
-            f"<a href='{url}'>youtu.be/{video_id}</a>\n\n"
-            f"{display}",
-            parse_mode="HTML",
-            disable_web_page_preview=True,
-            reply_markup=create_switch_keyboard(user_id, msg.message_id)
+        display = _truncate(summary, 4000)
+
+        await asyncio.gather(
+            msg.edit_text(
+                f"📺 <b>YouTube</b> {lang_flag} {cache_icon}\n"
+                f"<a href='{url}'>youtu.be/{video_id}</a>\n\n"
+                f"{display}",
+                disable_web_page_preview=True,
+                reply_markup=create_switch_keyboard(user_id, msg.message_id)
+            ),
+            _delete_quietly(message),
         )
-        try:
-            await message.delete()
-        except Exception as e:
-            logger.debug(f"message.delete() failed: {e}")
 
     except Exception as e:
-        logger.error(f"YouTube handler error: {e}")
+        logger.error("YouTube handler error: %s", e)
         await msg.edit_text(f"❌ Ошибка обработки YouTube: {str(e)[:100]}")
     finally:
         processing_users.discard(user_id)
 
 
-@dp.message(F.text.regexp(r'https?://\S+'))
+@dp.message(F.text.regexp(_URL_RE))
 async def url_handler(message: types.Message):
     """Обработка ссылок: скрейпим страницу и сразу показываем саммари."""
     url = message.text.strip()
@@ -1489,56 +2228,97 @@ async def url_handler(message: types.Message):
 
         save_to_history(user_id, msg.message_id, page_text, mode="summary", available_modes=available_modes)
 
-        if user_id in user_context and msg.message_id in user_context[user_id]:
-            user_context[user_id][msg.message_id]["type"] = "url"
-            user_context[user_id][msg.message_id]["chat_id"] = message.chat.id
-            user_context[user_id][msg.message_id]["original"] = page_text
-            user_context[user_id][msg.message_id]["cached_results"]["summary"] = summary
+        ctx = get_ctx(user_id, msg.message_id)
+        if ctx:
+            ctx["type"] = "url"
+            ctx["chat_id"] = message.chat.id
+            ctx["original"] = page_text
+            # В cached_results всё хранится уже санитизированным — как и результаты режимов
+            ctx["cached_results"]["summary"] = sanitize_llm_output(summary)
             schedule_persist(user_id, msg.message_id)
 
-        asyncio.create_task(_bg_save_transcript(user_id, "url", page_text, msg.message_id, message))
+        _spawn(_bg_save_transcript(user_id, "url", page_text, msg.message_id, message))
 
         domain = url.split("/")[2] if len(url.split("/")) > 2 else url
-        display = summary if len(summary) <= 4000 else summary[:3997] + "..."
-
-        await msg.edit_text(
-            f"🌐 <b>{domain}</b>\n\n{display}",
-            parse_mode="HTML",
-            reply_markup=create_switch_keyboard(user_id, msg.message_id)
+        display = _truncate(summary, 4000)
+
+        await asyncio.gather(
+            msg.edit_text(
+                f"🌐 <b>{domain}</b>\n\n{display}",
+                reply_markup=create_switch_keyboard(user_id, msg.message_id)
+            ),
+            _delete_quietly(message),
         )
-        try:
-            await message.delete()
-        except Exception as e:
-            logger.debug(f"message.delete() failed: {e}")
 
     except Exception as e:
-        logger.error(f"URL handler error: {e}")
+        logger.error("URL handler error: %s", e)
         await msg.edit_text(f"❌ Ошибка обработки ссылки: {str(e)[:100]}")
     finally:
         processing_users.discard(user_id)
 
 
-@dp.message(F.text)
+# Известные команды уже разобраны Command-фильтрами выше; прочие "/..." сюда не попадают
+@dp.message(F.text, ~F.text.startswith("/"))
 async def text_handler(message: types.Message):
     if is_shutting_down:
         await message.answer("🛑 Бот останавливается, попробуйте позже.")
         return
 
     user_id = message.from_user.id
-    original_text = message.text.strip()
 
     # Перехват: пользователь вводит имя файла для экспорта
     if user_id in pending_filename_inputs:
         await _handle_filename_input(message)
         return
 
-    # Диалоговый режим
-    if user_id in active_dialogs:
-        msg_id = active_dialogs[user_id]
-        await handle_streaming_answer(message, user_id, msg_id, message.text)
+    # Копим куски вставки и обрабатываем разом, когда хвост перестал приходить.
+    # Вопросы в диалоге тоже: разрезанная Telegram вставка — один вопрос, а не два стрима
+    messages, handle = _pending_text.pop(user_id, ([], None))
+    if handle is not None:
+        handle.cancel()
+    messages.append(message)
+    delay = (config.TEXT_BATCH_WINDOW_SPLIT if len(message.text) >= config.TEXT_SPLIT_THRESHOLD
+             else config.TEXT_BATCH_WINDOW)
+    handle = asyncio.get_running_loop().call_later(delay, _flush_pending_text, user_id)
+    _pending_text[user_id] = (messages, handle)
+
+
+def _flush_pending_text(user_id: int):
+    pending = _pending_text.pop(user_id, None)
+    if pending:
+        pending[1].cancel()
+        _track_task(_process_pending_text(pending[0]))
+
+
+async def _process_pending_text(messages: List[types.Message]):
+    """Склеенный текст обрабатывается вне апдейта — ErrorHandlingMiddleware его не видит, ловим сами."""
+    try:
+        await _process_text(messages)
+    except Exception as e:
+        stats["errors"] += 1
+        logger.error("❌ Необработанная ошибка в обработке текста: %s", e, exc_info=True)
+        if is_shutting_down:
+            return
+        try:
+            await messages[-1].answer("❌ Произошла внутренняя ошибка. Попробуйте позже.")
+        except Exception as notify_err:
+            logger.debug("Не смогли уведомить пользователя об ошибке: %s", notify_err)
+
+
+async def _process_text(messages: List[types.Message]):
+    message = messages[-1]
+    user_id = message.from_user.id
+    text = "\n".join(m.text for m in messages)
+    original_text = text.strip()
+
+    if is_shutting_down:
+        await message.answer("🛑 Бот останавливается, попробуйте позже.")
         return
 
-    if original_text.startswith("/"):
+    # Диалоговый режим: один dict-lookup, без сканирования user_context
+    msg_id = active_dialogs.get(user_id)
+    if msg_id is not None:
+        await handle_streaming_answer(message, user_id, msg_id, text)
         return
 
     if user_id in processing_users:
@@ -1549,44 +2329,22 @@ async def text_handler(message: types.Message):
     msg = await message.answer("📝 Анализирую текст...")
 
     try:
-        available_modes = processors.get_available_modes(original_text)
-        save_to_history(user_id, msg.message_id, original_text, mode="basic", available_modes=available_modes)
-
-        if user_id in user_context and msg.message_id in user_context[user_id]:
-            user_context[user_id][msg.message_id]["type"] = "text"
-            user_context[user_id][msg.message_id]["chat_id"] = message.chat.id
-            user_context[user_id][msg.message_id]["original"] = original_text
-
-        asyncio.create_task(_bg_save_transcript(user_id, "text", original_text, msg.message_id, message))
-
-        preview = original_text[:config.PREVIEW_LENGTH]
-        if len(original_text) > config.PREVIEW_LENGTH:
-            preview += "..."
-
-        modes_text = "📝 Как есть, ✨ Красиво"
-        if "summary" in available_modes:
-            modes_text += ", 📊 Саммари"
-
-        await msg.edit_text(
-            f"📝 <b>Полученный текст:</b>\n\n"
-            f"<i>{preview}</i>\n\n"
-            f"<b>Доступные режимы:</b> {modes_text}\n"
-            f"<b>Выберите вариант обработки:</b>",
-            parse_mode="HTML",
-            reply_markup=create_options_keyboard(user_id, msg.message_id)
-        )
-        try:
-            await message.delete()
-        except Exception as e:
-            logger.debug(f"message.delete() failed: {e}")
+        await _offer_modes(message, msg, original_text, kind="text", header=_HDR_TEXT, consumed=messages)
 
     except Exception as e:
-        logger.error(f"Text handler error: {e}")
+        logger.error("Text handler error: %s", e)
         await msg.edit_text("❌ Ошибка обработки текста")
     finally:
         processing_users.discard(user_id)
 
 
+# content_type → (file_id, имя файла): одна выборка из словаря вместо цепочки if/elif
+FILE_SOURCES: Dict[str, Callable[[types.Message], tuple]] = {
+    ContentType.PHOTO: lambda m: (m.photo[-1].file_id, f"photo_{m.photo[-1].file_unique_id}.jpg"),
+    ContentType.DOCUMENT: lambda m: (m.document.file_id, m.document.file_name or f"file_{m.document.file_unique_id}"),
+}
+
+
 @dp.message(F.photo | F.document)
 async def file_handler(message: types.Message):
     if is_shutting_down:
@@ -1600,37 +2358,52 @@ async def file_handler(message: types.Message):
         await message.answer(config.ERROR_BUSY)
         return
 
+    media = message.document or (message.photo[-1] if message.photo else None)
+    if media is not None and await _reject_oversized(message, media.file_size):
+        return
+
     processing_users.add(user_id)
+    source = FILE_SOURCES.get(message.content_type)
+    if source is not None:
+        file_id, filename = source(message)
+        file_task = _prefetch_file(file_id)
     msg = await message.answer("📁 Обрабатываю файл...")
 
     try:
-        file_info = None
-        filename = ""
-
-        if message.photo:
-            file_info = await bot.get_file(message.photo[-1].file_id)
-            filename = f"photo_{file_info.file_unique_id}.jpg"
-        elif message.document:
-            file_info = await bot.get_file(message.document.file_id)
-            filename = message.document.file_name or f"file_{file_info.file_unique_id}"
-
-        file_buffer = io.BytesIO()
-        await bot.download_file(file_info.file_path, file_buffer)
-        file_bytes = file_buffer.getvalue()
+        if source is None:
+            await msg.edit_text("❌ Неподдерживаемый тип файла")
+            return
+        file_info = await file_task
 
-        if len(file_bytes) > config.FILE_SIZE_LIMIT:
+        # Страховка, если в апдейте размера не было
+        if file_info.file_size and file_info.file_size > config.FILE_SIZE_LIMIT:
             await msg.edit_text(config.ERROR_FILE_TOO_LARGE)
             return
 
         file_ext = filename.lower().split('.')[-1] if '.' in filename else ''
 
-        # Прогресс-сообщение для PDF
-        if file_ext == 'pdf':
-            await msg.edit_text(config.MSG_PROCESSING_PDF)
-        else:
-            await msg.edit_text("🔍 Извлекаю текст...")
+        # Мелкие файлы — в память, крупные — на диск: PDF/DOCX парсятся с пути, без копии всего файла в RAM
+        # Прогресс-сообщение (для PDF — своё) уходит параллельно со скачиванием
+        status_text = config.MSG_PROCESSING_PDF if file_ext == 'pdf' else "🔍 Извлекаю текст..."
+        download_result, edit_result = await asyncio.gather(
+            _download_source(file_info, f"upload_{user_id}_{msg.message_id}"),
+            msg.edit_text(status_text),
+            return_exceptions=True,
+        )
+        if isinstance(download_result, BaseException):
+            raise download_result
+        if isinstance(edit_result, BaseException):
+            logger.debug("file status edit failed: %s", edit_result)
+
+        source = download_result
+        try:
+            if isinstance(source, str) and os.path.getsize(source) > config.FILE_SIZE_LIMIT:
+                await msg.edit_text(config.ERROR_FILE_TOO_LARGE)
+                return
 
-        original_text = await processors.extract_text_from_file(file_bytes, filename, groq_clients)
+            original_text = await processors.extract_text_from_file(source, filename, groq_clients)
+        finally:
+            await _release_source(source)
 
         if original_text.startswith("❌"):
             await msg.edit_text(original_text)
@@ -1640,47 +2413,19 @@ async def file_handler(message: types.Message):
             await msg.edit_text(config.ERROR_NO_TEXT_IN_FILE)
             return
 
-        available_modes = processors.get_available_modes(original_text)
-        save_to_history(user_id, msg.message_id, original_text, mode="basic", available_modes=available_modes)
-
-        if user_id in user_context and msg.message_id in user_context[user_id]:
-            user_context[user_id][msg.message_id]["type"] = "file"
-            user_context[user_id][msg.message_id]["chat_id"] = message.chat.id
-            user_context[user_id][msg.message_id]["filename"] = filename
-            user_context[user_id][msg.message_id]["original"] = original_text
-
-        source_type = "file"
-        if file_ext == "pdf":
-            source_type = "pdf"
-
-        asyncio.create_task(_bg_save_transcript(user_id, source_type, original_text, msg.message_id, message))
-
-        preview = original_text[:config.PREVIEW_LENGTH]
-        if len(original_text) > config.PREVIEW_LENGTH:
-            preview += "..."
-
-        modes_text = "📝 Как есть, ✨ Красиво"
-        if "summary" in available_modes:
-            modes_text += ", 📊 Саммари"
-
         is_image = filename.startswith("photo_") or file_ext in ['jpg', 'jpeg', 'png', 'gif', 'bmp', 'webp']
         file_type_label = "изображения" if is_image else "файла"
 
-        await msg.edit_text(
-            f"✅ <b>Извлечённый текст из {file_type_label}:</b>\n\n"
-            f"<i>{preview}</i>\n\n"
-            f"<b>Доступные режимы:</b> {modes_text}\n"
-            f"<b>Выберите вариант обработки:</b>",
-            parse_mode="HTML",
-            reply_markup=create_options_keyboard(user_id, msg.message_id)
+        await _offer_modes(
+            message, msg, original_text,
+            kind="file",
+            header=_HDR_EXTRACTED_FMT.format(file_type_label),
+            source_type="pdf" if file_ext == "pdf" else "file",
+            filename=filename,
         )
-        try:
-            await message.delete()
-        except Exception as e:
-            logger.debug(f"message.delete() failed: {e}")
 
     except Exception as e:
-        logger.error(f"File handler error: {e}")
+        logger.error("File handler error: %s", e)
         await msg.edit_text(f"❌ Ошибка обработки файла: {str(e)[:100]}")
     finally:
         processing_users.discard(user_id)
@@ -1690,55 +2435,54 @@ async def file_handler(message: types.Message):
 # ДИАЛОГОВЫЕ CALLBACKS
 # ============================================================================
 
-@dp.callback_query(F.data.startswith("dialog_start_"))
-async def dialog_start_callback(callback: types.CallbackQuery):
-    await callback.answer()
+def _ack_done(task: asyncio.Task):
+    if not task.cancelled() and task.exception():
+        logger.debug("callback.answer failed: %s", task.exception())
+
+
+def _ack(callback: types.CallbackQuery, *args, **kwargs):
+    """answerCallbackQuery в фоне: основная работа не ждёт лишний RTT до Telegram."""
+    _spawn(callback.answer(*args, **kwargs)).add_done_callback(_ack_done)
+
+
+@_route_callback(DialogCB, "start")
+async def dialog_start_callback(callback: types.CallbackQuery, callback_data: DialogCB):
+    _ack(callback)
     if is_shutting_down:
         await callback.message.answer("🛑 Бот останавливается.")
         return
 
-    parts = callback.data.split("_")
-    if len(parts) < 4:
-        return
-
-    user_id = int(parts[2])
-    msg_id = int(parts[3])
+    user_id = callback_data.user_id
+    msg_id = callback_data.msg_id
 
     if callback.from_user.id != user_id:
         await callback.answer("⚠️ Это не ваш запрос!", show_alert=True)
         return
 
-    if user_id not in user_context or msg_id not in user_context[user_id]:
+    ctx = await fetch_ctx(user_id, msg_id)
+    if not ctx:
         await callback.message.edit_text("❌ Документ не найден. Попробуйте заново.")
         return
 
-    doc_text = user_context[user_id][msg_id].get("original", "")
-    if not hasattr(processors, 'document_dialogues'):
-        processors.document_dialogues = {}
-    if user_id not in processors.document_dialogues:
-        processors.document_dialogues[user_id] = {}
-    processors.document_dialogues[user_id][msg_id] = {"text": doc_text, "history": []}
+    doc_text = ctx.get("original", "")
+    processors.document_dialogues.setdefault(user_id, {})[msg_id] = {"text": doc_text, "history": []}
     active_dialogs[user_id] = msg_id
 
-    filename = user_context[user_id][msg_id].get("filename", "документ")
+    filename = ctx.get("filename", "документ")
     await callback.message.edit_text(
         f"💬 <b>Режим вопросов активирован</b>\n\n"
         f"📄 Документ: {filename}\n"
         f"📊 Размер текста: {len(doc_text)} символов\n\n"
         f"Задавайте вопросы по содержимому.\n"
         f"Для выхода — /exit или кнопка ниже.",
-        parse_mode="HTML",
         reply_markup=create_dialog_keyboard(user_id)
     )
 
 
-@dp.callback_query(F.data.startswith("dialog_exit_"))
-async def dialog_exit_callback(callback: types.CallbackQuery):
-    await callback.answer()
-    parts = callback.data.split("_")
-    if len(parts) < 3:
-        return
-    user_id = int(parts[2])
+@_route_callback(DialogCB, "exit")
+async def dialog_exit_callback(callback: types.CallbackQuery, callback_data: DialogCB):
+    _ack(callback)
+    user_id = callback_data.user_id
     if callback.from_user.id != user_id:
         return
     active_dialogs.pop(user_id, None)
@@ -1749,8 +2493,75 @@ async def dialog_exit_callback(callback: types.CallbackQuery):
 # PROCESS / MODE / SWITCH CALLBACKS
 # ============================================================================
 
-@dp.callback_query(F.data.startswith("process_"))
-async def process_callback(callback: types.CallbackQuery):
+_MODE_PROCESSORS = {
+    "basic": processors.correct_text_basic,
+    "premium": processors.correct_text_premium,
+    "summary": processors.summarize_text,
+}
+
+# (режим, текст) -> задача Groq, которая уже выполняется
+_inflight_modes: Dict[tuple, asyncio.Task] = {}
+
+
+async def _answer_long(message: types.Message, text: str, reply_markup) -> None:
+    """
+    Длинный результат частями по 4000 символов вместо правки message.
+    Части уходят строго по порядку (параллельная отправка перемешала бы их в чате),
+    но удаление старого сообщения идёт одновременно с первой частью.
+    Клавиатура — отдельным сообщением: следующее переключение правит или удаляет
+    именно его, а не последнюю часть результата.
+    """
+    chunks = [text[i:i + 4000] for i in range(0, len(text), 4000)]
+    # Неудачное удаление не должно обрывать отправку остальных частей
+    await asyncio.gather(_delete_quietly(message), message.answer(chunks[0]))
+    for chunk in chunks[1:]:
+        await message.answer(chunk)
+    await message.answer("💾 <b>Переключение и экспорт:</b>", reply_markup=reply_markup)
+
+
+async def _run_mode(mode: str, text: str) -> str:
+    """Один запрос к Groq на (режим, текст): повторные и параллельные нажатия ждут общий результат."""
+    key = (mode, text)
+    task = _inflight_modes.get(key)
+    if task is None:
+        task = asyncio.create_task(_MODE_PROCESSORS[mode](text, groq_clients))
+        _inflight_modes[key] = task
+        task.add_done_callback(lambda _: _inflight_modes.pop(key, None))
+    # shield: отмена одного ожидающего не должна обрывать запрос остальным
+    return await asyncio.shield(task)
+
+
+async def _prefetch_modes(user_id: int, msg_id: int, text: str, modes: List[str]):
+    """Считает режимы заранее; нажатие во время расчёта присоединяется к той же задаче в _run_mode."""
+    results = await asyncio.gather(*(_run_mode(m, text) for m in modes), return_exceptions=True)
+    ctx = get_ctx(user_id, msg_id)
+    if not ctx:
+        return
+    stored = False
+    for mode, result in zip(modes, results):
+        if isinstance(result, BaseException):
+            logger.debug("prefetch %s failed: %s", mode, result)
+            continue
+        # Ошибки не кэшируем — при нажатии запрос повторится. Слоты режимов заранее
+        # заведены как None, поэтому проверяем значение, а не наличие ключа
+        if result and not result.startswith("❌") and not ctx["cached_results"].get(mode):
+            ctx["cached_results"][mode] = sanitize_llm_output(result)
+            stored = True
+    if stored:
+        schedule_persist(user_id, msg_id)
+
+
+def _schedule_prefetch(user_id: int, msg_id: int, text: str, available_modes: List[str]):
+    if not config.PREFETCH_MODES or not text.strip():
+        return
+    modes = ["basic"]
+    if len(text) < config.PREFETCH_MAX_CHARS:
+        modes += [m for m in ("premium", "summary") if m in available_modes]
+    _spawn(_prefetch_modes(user_id, msg_id, text, modes))
+
+
+@_route_callback(ProcessCB)
+async def process_callback(callback: types.CallbackQuery, callback_data: ProcessCB):
     if is_shutting_down:
         await callback.answer("🛑 Бот останавливается", show_alert=True)
         return
@@ -1758,71 +2569,60 @@ async def process_callback(callback: types.CallbackQuery):
     await callback.answer()
 
     try:
-        parts = callback.data.split("_")
-        if len(parts) < 4:
-            return
-
-        user_id = int(parts[1])
-        mode = parts[2]
-        msg_id = int(parts[3])
+        user_id = callback_data.user_id
+        mode = callback_data.mode
+        msg_id = callback_data.msg_id
 
         if callback.from_user.id != user_id:
             return
 
-        ctx_data = user_context.get(user_id, {}).get(msg_id)
+        ctx_data = await fetch_ctx(user_id, msg_id)
         if not ctx_data:
             await callback.answer("❌ Данные устарели. Перешлите сообщение.", show_alert=True)
             return
 
         original_text = ctx_data.get("original", ctx_data.get("text", ""))
 
-        await callback.message.edit_text(f"⏳ Обрабатываю ({mode})...")
+        # Результат мог уже посчитаться спекулятивно — тогда без Groq и без "Обрабатываю".
+        # В кэше он уже санитизирован: sanitize_llm_output не идемпотентна (&amp; → &amp;amp;)
+        result_clean = ctx_data["cached_results"].get(mode)
+        if not result_clean:
+            await callback.message.edit_text(f"⏳ Обрабатываю ({mode})...")
 
-        if mode == "basic":
-            result = await processors.correct_text_basic(original_text, groq_clients)
-        elif mode == "premium":
-            result = await processors.correct_text_premium(original_text, groq_clients)
-        elif mode == "summary":
-            result = await processors.summarize_text(original_text, groq_clients)
-        else:
-            result = original_text
+            if mode in _MODE_PROCESSORS:
+                result = await _run_mode(mode, original_text)
+            else:
+                result = original_text
+            result_clean = sanitize_llm_output(result)
 
-        result_clean = sanitize_llm_output(result)
-        user_context[user_id][msg_id]["mode"] = mode
-        user_context[user_id][msg_id]["cached_results"][mode] = result_clean
+        # Пишем в ctx_data: пока ждали Groq, запись могли вытеснить из user_context
+        ctx_data["mode"] = mode
+        ctx_data["cached_results"][mode] = result_clean
         schedule_persist(user_id, msg_id)
 
         # Сохраняем результат в БД в фоне
         transcript_id = ctx_data.get("transcript_id")
         if transcript_id:
-            asyncio.create_task(database.save_result(transcript_id, mode, result_clean))
+            _spawn(database.save_result(transcript_id, mode, result_clean))
 
         available_modes = ctx_data.get("available_modes", ["basic", "premium"])
 
         if len(result_clean) > 4000:
-            await callback.message.delete()
-            for i in range(0, len(result_clean), 4000):
-                await callback.message.answer(result_clean[i:i+4000], parse_mode="HTML")
-            await callback.message.answer(
-                "💾 <b>Переключение и экспорт:</b>",
-                parse_mode="HTML",
-                reply_markup=create_switch_keyboard(user_id, msg_id)
-            )
+            await _answer_long(callback.message, result_clean, create_switch_keyboard(user_id, msg_id))
         else:
             await callback.message.edit_text(
                 result_clean,
-                parse_mode="HTML",
                 reply_markup=create_switch_keyboard(user_id, msg_id)
             )
 
     except Exception as e:
-        logger.error(f"Process callback error: {e}")
+        logger.error("Process callback error: %s", e)
         if not is_shutting_down:
             await callback.message.edit_text("❌ Ошибка обработки")
 
 
-@dp.callback_query(F.data.startswith("mode_"))
-async def mode_callback(callback: types.CallbackQuery):
+@_route_callback(ModeCB)
+async def mode_callback(callback: types.CallbackQuery, callback_data: ModeCB):
     if is_shutting_down:
         await callback.answer("🛑 Бот останавливается", show_alert=True)
         return
@@ -1830,15 +2630,11 @@ async def mode_callback(callback: types.CallbackQuery):
     await callback.answer()
 
     try:
-        parts = callback.data.split("_")
-        if len(parts) < 3:
-            return
-
-        new_mode = parts[1]
-        msg_id = int(parts[2])
+        new_mode = callback_data.mode
+        msg_id = callback_data.msg_id
         user_id = callback.from_user.id
 
-        ctx_data = user_context.get(user_id, {}).get(msg_id)
+        ctx_data = await fetch_ctx(user_id, msg_id)
         if not ctx_data:
             await callback.answer("❌ Данные устарели.", show_alert=True)
             return
@@ -1848,38 +2644,33 @@ async def mode_callback(callback: types.CallbackQuery):
         await callback.answer("Обрабатываю...")
         original_text = ctx_data.get("original", ctx_data.get("text", ""))
 
-        if new_mode == "basic":
-            processed = await processors.correct_text_basic(original_text, groq_clients)
-        elif new_mode == "premium":
-            processed = await processors.correct_text_premium(original_text, groq_clients)
-        elif new_mode == "summary":
-            processed = await processors.summarize_text(original_text, groq_clients)
+        if new_mode in _MODE_PROCESSORS:
+            processed = await _run_mode(new_mode, original_text)
         else:
             processed = original_text
 
         processed_clean = sanitize_llm_output(processed)
-        user_context[user_id][msg_id]["mode"] = new_mode
-        user_context[user_id][msg_id]["cached_results"][new_mode] = processed_clean
+        ctx_data["mode"] = new_mode
+        ctx_data["cached_results"][new_mode] = processed_clean
         schedule_persist(user_id, msg_id)
 
         transcript_id = ctx_data.get("transcript_id")
         if transcript_id:
-            asyncio.create_task(database.save_result(transcript_id, new_mode, processed_clean))
+            _spawn(database.save_result(transcript_id, new_mode, processed_clean))
 
         await callback.message.edit_text(
             processed_clean,
-            parse_mode="HTML",
             reply_markup=create_keyboard(msg_id, new_mode, ctx_data.get("available_modes", ["basic", "premium"]))
         )
 
     except Exception as e:
-        logger.error(f"Mode callback error: {e}")
+        logger.error("Mode callback error: %s", e)
         if not is_shutting_down:
             await callback.message.edit_text("❌ Ошибка переключения")
 
 
-@dp.callback_query(F.data.startswith("switch_"))
-async def switch_callback(callback: types.CallbackQuery):
+@_route_callback(SwitchCB)
+async def switch_callback(callback: types.CallbackQuery, callback_data: SwitchCB):
     if is_shutting_down:
         await callback.answer("🛑 Бот останавливается", show_alert=True)
         return
@@ -1887,18 +2678,14 @@ async def switch_callback(callback: types.CallbackQuery):
     await callback.answer()
 
     try:
-        parts = callback.data.split("_")
-        if len(parts) < 4:
-            return
-
-        target_user_id = int(parts[1])
-        target_mode = parts[2]
-        msg_id = int(parts[3])
+        target_user_id = callback_data.user_id
+        target_mode = callback_data.mode
+        msg_id = callback_data.msg_id
 
         if callback.from_user.id != target_user_id:
             return
 
-        ctx_data = user_context.get(target_user_id, {}).get(msg_id)
+        ctx_data = await fetch_ctx(target_user_id, msg_id)
         if not ctx_data:
             await callback.message.answer("❌ Текст не найден. Обработайте заново.")
             return
@@ -1908,49 +2695,46 @@ async def switch_callback(callback: types.CallbackQuery):
             await callback.answer("⚠️ Этот режим недоступен", show_alert=True)
             return
 
+        # Старая клавиатура или двойной тап: текст уже в этом режиме — правим только кнопки,
+        # иначе Telegram ответит "message is not modified" и мы затрём текст ошибкой
+        if ctx_data.get("mode") == target_mode:
+            try:
+                await callback.message.edit_reply_markup(reply_markup=create_switch_keyboard(target_user_id, msg_id))
+            except TelegramBadRequest as e:
+                logger.debug("edit_reply_markup skipped: %s", e)
+            return
+
         cached = ctx_data["cached_results"].get(target_mode)
 
         if cached:
+            # В кэше (и в восстановленном из БД контексте) текст уже санитизирован
             result = cached
         else:
             await callback.message.edit_text(f"⏳ Обрабатываю ({target_mode})...")
             original_text = ctx_data.get("original", ctx_data.get("text", ""))
 
-            if target_mode == "basic":
-                result = await processors.correct_text_basic(original_text, groq_clients)
-            elif target_mode == "premium":
-                result = await processors.correct_text_premium(original_text, groq_clients)
-            elif target_mode == "summary":
-                result = await processors.summarize_text(original_text, groq_clients)
+            if target_mode in _MODE_PROCESSORS:
+                result = await _run_mode(target_mode, original_text)
             else:
                 result = "❌ Неизвестный режим"
 
             result = sanitize_llm_output(result)
-            user_context[target_user_id][msg_id]["cached_results"][target_mode] = result
+            ctx_data["cached_results"][target_mode] = result
             schedule_persist(target_user_id, msg_id)
 
             transcript_id = ctx_data.get("transcript_id")
             if transcript_id:
-                asyncio.create_task(database.save_result(transcript_id, target_mode, sanitize_for_db(result)))
+                _spawn(database.save_result(transcript_id, target_mode, sanitize_for_db(result)))
 
-        user_context[target_user_id][msg_id]["mode"] = target_mode
-        # Санитизируем для Telegram (если result пришёл из кэша — ещё не обработан)
-        result = sanitize_llm_output(result)
+        ctx_data["mode"] = target_mode
 
         if len(result) > 4000:
-            await callback.message.delete()
-            for i in range(0, len(result), 4000):
-                await callback.message.answer(result[i:i+4000], parse_mode="HTML")
-            await callback.message.answer(
-                "💾 <b>Переключение и экспорт:</b>",
-                parse_mode="HTML",
-                reply_markup=create_switch_keyboard(target_user_id, msg_id)
-            )
+            await _answer_long(callback.message, result, create_switch_keyboard(target_user_id, msg_id))
         else:
-            await callback.message.edit_text(result, parse_mode="HTML", reply_markup=create_switch_keyboard(target_user_id, msg_id))
+            await callback.message.edit_text(result, reply_markup=create_switch_keyboard(target_user_id, msg_id))
 
     except Exception as e:
-        logger.error(f"Switch callback error: {e}")
+        logger.error("Switch callback error: %s", e)
         if not is_shutting_down:
             await callback.message.edit_text("❌ Ошибка переключения")
 
@@ -1978,7 +2762,7 @@ async def _do_export(
     else:
         chat_msg = callback_or_message
 
-    ctx_data = user_context.get(target_user_id, {}).get(msg_id)
+    ctx_data = await fetch_ctx(target_user_id, msg_id)
     if not ctx_data:
         await chat_msg.answer("❌ Текст не найден.")
         return
@@ -1988,44 +2772,45 @@ async def _do_export(
         await chat_msg.answer("⚠️ Текст не найден")
         return
 
-    format_labels = {"txt": "📄 TXT", "pdf": "📊 PDF", "docx": "📝 DOCX"}
-    status_msg = await chat_msg.answer(f"📁 Создаю {format_labels.get(export_format, 'файл')}...")
+    caption_map = {"txt": "📄 Текстовый файл", "pdf": "📊 PDF файл", "docx": "📝 DOCX файл"}
 
-    filepath = await save_to_file(
-        target_user_id, text, export_format, mode=mode, custom_name=custom_name,
-    )
+    if export_format != "txt":
+        format_labels = {"pdf": "📊 PDF", "docx": "📝 DOCX"}
+        status_msg = await chat_msg.answer(f"📁 Создаю {format_labels.get(export_format, 'файл')}...")
 
-    if not filepath:
-        try:
-            await status_msg.edit_text("❌ Ошибка создания файла")
-        except Exception as e:
-            logger.debug(f"edit_text failed in export: {e}")
-        return
+        filepath = await save_to_file(
+            target_user_id, text, export_format, mode=mode, custom_name=custom_name,
+        )
+        if filepath:
+            active_temp_files.add(filepath)
+            try:
+                document = FSInputFile(filepath, filename=os.path.basename(filepath))
+                await chat_msg.answer_document(document=document, caption=caption_map.get(export_format, "📁 Файл"))
+                try:
+                    await status_msg.delete()
+                except Exception as e:
+                    logger.debug("status_msg delete failed: %s", e)
+            finally:
+                await _remove_temp(filepath)
+            return
 
-    filename = os.path.basename(filepath)
-    caption_map = {"txt": "📄 Текстовый файл", "pdf": "📊 PDF файл", "docx": "📝 DOCX файл"}
-    caption = caption_map.get(export_format, "📁 Файл")
+        # PDF/DOCX собрать не удалось — fallback на TXT тем же путём, что и обычный TXT-экспорт
+        await _delete_quietly(status_msg)
 
-    try:
-        document = FSInputFile(filepath, filename=filename)
-        await chat_msg.answer_document(document=document, caption=caption)
-        try:
-            await status_msg.delete()
-        except Exception as e:
-            logger.debug(f"status_msg delete failed: {e}")
-    finally:
-        try:
-            os.remove(filepath)
-        except OSError as e:
-            logger.debug(f"temp file cleanup failed: {e}")
+    # TXT — это просто text.encode(): байты уходят в Telegram без записи на диск
+    filename = f"{build_export_filename(target_user_id, mode, custom_name)}.txt"
+    await chat_msg.answer_document(
+        document=BufferedInputFile(text.encode("utf-8"), filename=filename),
+        caption=caption_map["txt"],
+    )
 
 
 def _make_filename_prompt_keyboard(token: str) -> InlineKeyboardMarkup:
     """Клавиатура под промптом ввода имени: только 'Без названия' и 'Отмена'."""
     builder = InlineKeyboardBuilder()
     builder.row(
-        InlineKeyboardButton(text="🏷️ Без названия", callback_data=f"noname_{token}"),
-        InlineKeyboardButton(text="✖️ Отмена",      callback_data=f"cancelexp_{token}"),
+        InlineKeyboardButton(text="🏷️ Без названия", callback_data=FilenameCB(action="noname", token=token).pack()),
+        InlineKeyboardButton(text="✖️ Отмена",      callback_data=FilenameCB(action="cancel", token=token).pack()),
     )
     return builder.as_markup()
 
@@ -2044,14 +2829,14 @@ async def _filename_input_timeout(user_id: int, prompt_msg_id: int, chat_id: int
                 text=config.MSG_FILENAME_TIMEOUT,
             )
         except Exception as e:
-            logger.debug(f"timeout edit_message failed: {e}")
+            logger.debug("timeout edit_message failed: %s", e)
     except asyncio.CancelledError:
         # Нормальный путь — пользователь успел ответить
         pass
 
 
-@dp.callback_query(F.data.startswith("export_"))
-async def export_callback(callback: types.CallbackQuery):
+@_route_callback(ExportCB)
+async def export_callback(callback: types.CallbackQuery, callback_data: ExportCB):
     """Шаг 1: спрашиваем имя файла. Реальное создание — в продолжении flow."""
     if is_shutting_down:
         await callback.answer("🛑 Бот останавливается", show_alert=True)
@@ -2060,27 +2845,16 @@ async def export_callback(callback: types.CallbackQuery):
     await callback.answer()
 
     try:
-        parts = callback.data.split("_")
-
-        # Два формата: export_mode_msgid_fmt (из create_keyboard)
-        # и export_userid_mode_msgid_fmt (из create_switch_keyboard)
-        if len(parts) == 4:
-            mode = parts[1]
-            msg_id = int(parts[2])
-            export_format = parts[3]
-            target_user_id = callback.from_user.id
-        elif len(parts) == 5:
-            target_user_id = int(parts[1])
-            mode = parts[2]
-            msg_id = int(parts[3])
-            export_format = parts[4]
-        else:
-            return
+        # Кнопки из create_keyboard не несут user_id — владелец тот, кто нажал
+        target_user_id = callback_data.user_id or callback.from_user.id
+        mode = callback_data.mode
+        msg_id = callback_data.msg_id
+        export_format = callback_data.fmt
 
         if callback.from_user.id != target_user_id:
             return
 
-        ctx_data = user_context.get(target_user_id, {}).get(msg_id)
+        ctx_data = await fetch_ctx(target_user_id, msg_id)
         if not ctx_data:
             await callback.message.answer("❌ Текст не найден.")
             return
@@ -2097,7 +2871,6 @@ async def export_callback(callback: types.CallbackQuery):
         prompt = config.MSG_ASK_FILENAME.format(max_len=config.CUSTOM_FILENAME_MAX_LENGTH)
         prompt_msg = await callback.message.answer(
             prompt,
-            parse_mode="HTML",
             reply_markup=_make_filename_prompt_keyboard(token),
         )
 
@@ -2117,13 +2890,13 @@ async def export_callback(callback: types.CallbackQuery):
         }
 
     except Exception as e:
-        logger.error(f"Export callback error: {e}")
+        logger.error("Export callback error: %s", e)
         if not is_shutting_down:
             await callback.message.answer("❌ Ошибка подготовки экспорта")
 
 
-@dp.callback_query(F.data.startswith("noname_"))
-async def export_noname_callback(callback: types.CallbackQuery):
+@_route_callback(FilenameCB, "noname")
+async def export_noname_callback(callback: types.CallbackQuery, callback_data: FilenameCB):
     """Пользователь нажал «Без названия» → экспорт с автогенерируемым именем."""
     if is_shutting_down:
         await callback.answer("🛑 Бот останавливается", show_alert=True)
@@ -2136,7 +2909,7 @@ async def export_noname_callback(callback: types.CallbackQuery):
         try:
             await callback.message.edit_text("⚠️ Запрос устарел. Нажмите кнопку формата ещё раз.")
         except Exception as e:
-            logger.debug(f"noname edit_text failed: {e}")
+            logger.debug("noname edit_text failed: %s", e)
         return
 
     task = pending.get("task")
@@ -2146,7 +2919,7 @@ async def export_noname_callback(callback: types.CallbackQuery):
     try:
         await callback.message.delete()
     except Exception as e:
-        logger.debug(f"noname prompt delete failed: {e}")
+        logger.debug("noname prompt delete failed: %s", e)
 
     await _do_export(
         callback,
@@ -2158,8 +2931,8 @@ async def export_noname_callback(callback: types.CallbackQuery):
     )
 
 
-@dp.callback_query(F.data.startswith("cancelexp_"))
-async def export_cancel_callback(callback: types.CallbackQuery):
+@_route_callback(FilenameCB, "cancel")
+async def export_cancel_callback(callback: types.CallbackQuery, callback_data: FilenameCB):
     """Отмена ввода имени."""
     await callback.answer("Отменено")
     user_id = callback.from_user.id
@@ -2171,7 +2944,7 @@ async def export_cancel_callback(callback: types.CallbackQuery):
     try:
         await callback.message.delete()
     except Exception as e:
-        logger.debug(f"cancel prompt delete failed: {e}")
+        logger.debug("cancel prompt delete failed: %s", e)
 
 
 async def _handle_filename_input(message: types.Message):
@@ -2209,7 +2982,7 @@ async def _handle_filename_input(message: types.Message):
     try:
         await message.delete()
     except Exception as e:
-        logger.debug(f"user filename msg delete failed: {e}")
+        logger.debug("user filename msg delete failed: %s", e)
 
     # Удаляем промпт
     try:
@@ -2217,7 +2990,7 @@ async def _handle_filename_input(message: types.Message):
             chat_id=pending["chat_id"], message_id=pending["prompt_msg_id"]
         )
     except Exception as e:
-        logger.debug(f"prompt delete failed: {e}")
+        logger.debug("prompt delete failed: %s", e)
 
     await _do_export(
         message,
@@ -2234,20 +3007,17 @@ async def _handle_filename_input(message: types.Message):
 # TRANSLATE CALLBACKS
 # ============================================================================
 
-@dp.callback_query(F.data.startswith("translate_back_"))
-async def translate_back_callback(callback: types.CallbackQuery):
+@_route_callback(TranslateCB, "back")
+async def translate_back_callback(callback: types.CallbackQuery, callback_data: TranslateCB):
     """Возврат к оригинальному тексту после перевода."""
     await callback.answer()
-    parts = callback.data.split("_")
-    if len(parts) < 4:
-        return
-    user_id = int(parts[2])
-    msg_id = int(parts[3])
+    user_id = callback_data.user_id
+    msg_id = callback_data.msg_id
 
     if callback.from_user.id != user_id:
         return
 
-    ctx_data = user_context.get(user_id, {}).get(msg_id)
+    ctx_data = await fetch_ctx(user_id, msg_id)
     if not ctx_data:
         await callback.answer("❌ Данные устарели.", show_alert=True)
         return
@@ -2256,12 +3026,12 @@ async def translate_back_callback(callback: types.CallbackQuery):
     original_result = ctx_data["cached_results"].get(current_mode) or ctx_data.get("original", "")
     ctx_data["is_translated"] = False
 
-    display = original_result if len(original_result) <= 4000 else original_result[:3997] + "..."
+    display = _truncate(original_result, 4000)
     await callback.message.edit_text(display, reply_markup=create_switch_keyboard(user_id, msg_id))
 
 
-@dp.callback_query(F.data.regexp(r'^translate_\d+_\d+$'))
-async def translate_callback(callback: types.CallbackQuery):
+@_route_callback(TranslateCB, "to")
+async def translate_callback(callback: types.CallbackQuery, callback_data: TranslateCB):
     """Перевод текущего варианта на русский язык."""
     if is_shutting_down:
         await callback.answer("🛑 Бот останавливается", show_alert=True)
@@ -2270,16 +3040,13 @@ async def translate_callback(callback: types.CallbackQuery):
     await callback.answer()
 
     try:
-        parts = callback.data.split("_")
-        if len(parts) < 3:
-            return
-        user_id = int(parts[1])
-        msg_id = int(parts[2])
+        user_id = callback_data.user_id
+        msg_id = callback_data.msg_id
 
         if callback.from_user.id != user_id:
             return
 
-        ctx_data = user_context.get(user_id, {}).get(msg_id)
+        ctx_data = await fetch_ctx(user_id, msg_id)
         if not ctx_data:
             await callback.answer("❌ Данные устарели.", show_alert=True)
             return
@@ -2301,11 +3068,11 @@ async def translate_callback(callback: types.CallbackQuery):
 
         ctx_data["is_translated"] = True
 
-        display = translated if len(translated) <= 4000 else translated[:3997] + "..."
-        await callback.message.edit_text(sanitize_llm_output(display), parse_mode="HTML", reply_markup=create_switch_keyboard(user_id, msg_id))
+        display = _truncate(translated, 4000)
+        await callback.message.edit_text(sanitize_llm_output(display), reply_markup=create_switch_keyboard(user_id, msg_id))
 
     except Exception as e:
-        logger.error(f"Translate callback error: {e}")
+        logger.error("Translate callback error: %s", e)
         if not is_shutting_down:
             await callback.message.answer("❌ Ошибка перевода")
 
@@ -2314,8 +3081,8 @@ async def translate_callback(callback: types.CallbackQuery):
 # BREAKDOWN CALLBACK — "Разобрать по косточкам"
 # ============================================================================
 
-@dp.callback_query(F.data.startswith("breakdown_"))
-async def breakdown_callback(callback: types.CallbackQuery):
+@_route_callback(BreakdownCB)
+async def breakdown_callback(callback: types.CallbackQuery, callback_data: BreakdownCB):
     """Разбор исправлений между оригиналом и обработанным текстом."""
     if is_shutting_down:
         await callback.answer("🛑 Бот останавливается", show_alert=True)
@@ -2324,14 +3091,10 @@ async def breakdown_callback(callback: types.CallbackQuery):
     await callback.answer("🧠 Анализирую правки...")
 
     try:
-        parts = callback.data.split("_")
-        if len(parts) < 2:
-            return
-
-        msg_id = int(parts[1])
+        msg_id = callback_data.msg_id
         user_id = callback.from_user.id
 
-        ctx_data = user_context.get(user_id, {}).get(msg_id)
+        ctx_data = await fetch_ctx(user_id, msg_id)
         if not ctx_data:
             await callback.message.answer("❌ Данные устарели. Обработайте текст заново.")
             return
@@ -2354,12 +3117,11 @@ async def breakdown_callback(callback: types.CallbackQuery):
 
         mode_label = "«Как есть»" if current_mode == "basic" else "«Красиво»"
         await status_msg.edit_text(
-            f"🧠 <b>Разбор правок — режим {mode_label}:</b>\n\n{sanitize_llm_output(result)}",
-            parse_mode="HTML"
+            f"🧠 <b>Разбор правок — режим {mode_label}:</b>\n\n{sanitize_llm_output(result)}"
         )
 
     except Exception as e:
-        logger.error(f"Breakdown callback error: {e}")
+        logger.error("Breakdown callback error: %s", e)
         if not is_shutting_down:
             await callback.message.answer("❌ Ошибка при разборе правок")
 
@@ -2371,17 +3133,24 @@ async def breakdown_callback(callback: types.CallbackQuery):
 if __name__ == "__main__":
     try:
         port = int(os.environ.get("PORT", 8080))
-        logger.info(f"🚀 Starting server on port {port}")
+        # uvloop (libuv) заметно дешевле стандартного selector-loop на сокетах
+        try:
+            import uvloop  # noqa: F401
+            loop_impl = "uvloop"
+        except ImportError:
+            loop_impl = "asyncio"
+        logger.info("🚀 Starting server on port %s (loop=%s)", port, loop_impl)
         uvicorn.run(
             "bot:app",
             host="0.0.0.0",
             port=port,
             log_level="info",
             workers=1,
-            loop="asyncio"
+            loop=loop_impl,
+            timeout_keep_alive=config.WEB_KEEPALIVE_TIMEOUT,
         )
     except KeyboardInterrupt:
         logger.info("Bot stopped by user (Ctrl+C)")
     except Exception as e:
-        logger.critical(f"❌ Fatal error: {e}", exc_info=True)
+        logger.critical("❌ Fatal error: %s", e, exc_info=True)
         sys.exit(1)
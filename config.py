@@ -5,17 +5,52 @@
 """
 
 import logging
+import math
 import os
 
+
+def _env_float(name: str, default: float) -> float:
+    """Читает float из окружения; мусор, NaN и inf откатываются на default."""
+    try:
+        value = float(os.environ.get(name, default))
+    except (TypeError, ValueError):
+        return default
+    return value if math.isfinite(value) and value >= 0 else default
+
+
 # === ТАЙМАУТЫ И ЛИМИТЫ ===
 CACHE_TIMEOUT_SECONDS = 3600
 CACHE_CHECK_INTERVAL = 300
+SHUTDOWN_DRAIN_TIMEOUT = 10   # сколько ждать незавершённые обработки при остановке
 MAX_CONTEXTS = 1000
 MAX_CONTEXTS_PER_USER = 10
+USER_CONTEXT_CAPACITY = 10000            # максимум пользователей в user_context (LRU)
+USER_CONTEXT_TTL_SEC = 86400             # пользователь без обращений дольше суток выселяется
+USER_CONTEXT_MAX_CHARS = 20_000_000       # суммарный объём текстов в user_context (~40 MB кириллицы)
+ACTIVE_DIALOGS_CAPACITY = 50000          # максимум одновременных режимов вопросов
+ACTIVE_DIALOGS_TTL_SEC = 3600            # режим вопросов без активности закрывается через час
 FILE_SIZE_LIMIT = 100 * 1024 * 1024      # 100 MB
+TELEGRAM_DOWNLOAD_LIMIT = 20 * 1024 * 1024  # getFile облачного Bot API отдаёт файлы не больше 20 MB
+IN_MEMORY_DOWNLOAD_LIMIT = 2 * 1024 * 1024  # файлы до 2 MB качаются в память, крупнее — на диск
 GROQ_TIMEOUT = 120.0
+GROQ_PING_TIMEOUT = 3.0   # проверка ключей на старте
 GROQ_RETRY_COUNT = 3
 
+# === TELEGRAM HTTP-СЕССИЯ (aiohttp) ===
+TELEGRAM_HTTP_LIMIT = 200
+TELEGRAM_HTTP_LIMIT_PER_HOST = 100
+TELEGRAM_HTTP_KEEPALIVE = 75
+TELEGRAM_HTTP_DNS_TTL = 300
+
+# === ВЕБ-СЕРВЕР ===
+# Keep-alive входящих соединений (uvicorn по умолчанию держит лишь 5 с)
+WEB_KEEPALIVE_TIMEOUT = 75
+
+# === GROQ HTTP-ПУЛ (один на все ключи) ===
+GROQ_HTTP_MAX_CONNECTIONS = 100
+GROQ_HTTP_MAX_KEEPALIVE = 100
+GROQ_HTTP_KEEPALIVE_EXPIRY = 60
+
 # === ТЕМПЕРАТУРЫ ===
 MODEL_TEMPERATURES = {
     "transcription": 0.0,
@@ -47,12 +82,34 @@ SUMMARIZATION_TEMPERATURE = 0.3
 MIN_TEXT_LENGTH = 10
 MIN_WORDS_FOR_SUMMARY = 80
 MIN_CHARS_FOR_SUMMARY = 500
+MIN_CHARS_FOR_QUESTION = 100   # кнопка «Задать вопрос» для саммари длиннее этого
 PREVIEW_LENGTH = 200
 MAX_DIALOG_HISTORY = 20
 
+# === СПЕКУЛЯТИВНАЯ ОБРАБОТКА ===
+# Пока пользователь выбирает режим, basic считается заранее; premium/summary — только для коротких текстов
+PREFETCH_MODES = True
+PREFETCH_MAX_CHARS = 3000
+
+# === СТРИМИНГ ОТВЕТОВ В TELEGRAM ===
+# Telegram режет частые правки одного сообщения (~1 edit/сек на чат)
+STREAM_EDIT_INTERVAL = _env_float("STREAM_EDIT_INTERVAL", 0.8)   # секунд между правками
+STREAM_EDIT_MIN_DELTA = 24                                          # минимум новых символов
+STREAM_MESSAGE_LIMIT = 4000   # сколько символов ответа в одном сообщении, дальше — новое сообщение
+
+# === СКЛЕЙКА ДЛИННЫХ ВСТАВОК ===
+# Telegram режет длинную вставку на куски ~4096 символов и шлёт отдельными апдейтами.
+# Ждём хвост: короткое окно для обычного текста, длинное — если кусок упёрся в лимит.
+TEXT_BATCH_WINDOW = min(_env_float("TEXT_BATCH_WINDOW", 0.3), 5.0)
+TEXT_BATCH_WINDOW_SPLIT = min(_env_float("TEXT_BATCH_WINDOW_SPLIT", 1.0), 5.0)
+TEXT_SPLIT_THRESHOLD = 4000
+
 # === PDF ===
 PDF_MAX_PAGES = None
 
+# Сколько тяжёлых разборов файлов (PDF/DOCX) идёт в потоках одновременно
+MAX_CONCURRENT_EXTRACTIONS = 4
+
 # === ЛОГИРОВАНИЕ ===
 LOG_LEVEL = logging.INFO
 LOG_TRANSCRIPTION_LANGUAGE = True
@@ -61,6 +118,12 @@ LOG_TRANSCRIPTION_LANGUAGE = True
 TEMP_DIR = "/tmp"
 CLEANUP_TEMP_FILES = True
 TEMP_FILE_RETENTION = 300
+# Префиксы наших временных файлов (по ним работает периодическая очистка)
+TEMP_FILE_PREFIXES = ('video_', 'audio_', 'text_', 'export_', 'upload_')
+# Экспорты раскладываются по подкаталогам <user_id % 256> — ни в одном не копятся тысячи файлов
+EXPORT_DIR = f"{TEMP_DIR}/voicebot_exports"
+# Сколько живёт забытый экспорт (например, после падения между отправкой и удалением)
+EXPORT_FILE_RETENTION = 3600
 
 # === ПОЛЬЗОВАТЕЛЬСКОЕ ИМЯ ФАЙЛА ===
 # Лимит на пользовательскую часть имени (без префикса режима и даты)
@@ -268,6 +331,7 @@ ERROR_NO_GROQ = "❌ Для распознавания изображений н
 ERROR_EMPTY_TEXT = "❌ Пустой текст"
 ERROR_TEXT_TOO_SHORT_FOR_SUMMARY = "📝 Текст слишком короткий для саммари. Используйте обычную коррекцию."
 ERROR_FILE_TOO_LARGE = "❌ Файл слишком большой (максимум 100 MB)"
+ERROR_TELEGRAM_FILE_TOO_LARGE = "❌ Файл больше 20 MB — Telegram не даёт ботам скачивать такие файлы"
 ERROR_NO_TEXT_IN_FILE = "❌ Не удалось найти текст в файле. Попробуйте: более чёткое изображение, файл с текстовым содержимым, прямой текст сообщением"
 ERROR_DOC_NOT_SUPPORTED = "❌ DOC файлы (старый формат Word) не поддерживаются. Сохраните файл как DOCX."
 ERROR_VIDEO_TOO_LONG = "❌ Видео слишком длинное (максимум 60 минут)"
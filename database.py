@@ -9,7 +9,7 @@ import os
 import asyncio
 import logging
 from typing import Optional, List, Dict, Any
-from datetime import datetime
+from datetime import datetime, timedelta
 
 logger = logging.getLogger(__name__)
 
@@ -50,7 +50,7 @@ def init_database() -> bool:
         _available = False
         return False
     except Exception as e:
-        logger.warning(f"⚠️  Supabase недоступен: {e}. Работаем без БД.")
+        logger.warning("⚠️  Supabase недоступен: %s. Работаем без БД.", e)
         _available = False
         return False
 
@@ -73,7 +73,7 @@ def _safe_execute(func):
     try:
         return func()
     except Exception as e:
-        logger.warning(f"⚠️  Supabase ошибка: {e}")
+        logger.warning("⚠️  Supabase ошибка: %s", e)
         return None
 
 
@@ -100,7 +100,7 @@ async def keep_alive_loop():
             await _run(lambda: _client.table("users").select("id").limit(1).execute())
             logger.debug("💓 Supabase keep-alive OK")
         except Exception as e:
-            logger.debug(f"💓 Supabase keep-alive failed: {e}")
+            logger.debug("💓 Supabase keep-alive failed: %s", e)
 
 
 # ============================================================================
@@ -249,7 +249,6 @@ async def load_active_user_contexts(max_age_seconds: int) -> List[Dict[str, Any]
     if not _available:
         return []
 
-    from datetime import timedelta
     cutoff = (datetime.utcnow() - timedelta(seconds=max_age_seconds)).isoformat()
 
     result = await _run(lambda: (
@@ -263,6 +262,30 @@ async def load_active_user_contexts(max_age_seconds: int) -> List[Dict[str, Any]
     return []
 
 
+async def load_user_context(user_id: int, msg_id: int, max_age_seconds: int) -> Optional[Dict[str, Any]]:
+    """
+    Одна запись контекста не старше max_age_seconds — для подгрузки по требованию,
+    когда запись уже вытеснена из памяти. None если нет / БД недоступна.
+    """
+    if not _available:
+        return None
+
+    cutoff = (datetime.utcnow() - timedelta(seconds=max_age_seconds)).isoformat()
+
+    result = await _run(lambda: (
+        _client.table("user_contexts")
+        .select("payload, updated_at")
+        .eq("user_id", user_id)
+        .eq("msg_id", msg_id)
+        .gte("updated_at", cutoff)
+        .limit(1)
+        .execute()
+    ))
+    if result and result.data:
+        return result.data[0]
+    return None
+
+
 async def cleanup_stale_user_contexts(max_age_seconds: int) -> int:
     """
     Удалить из БД контексты старше max_age_seconds.
@@ -272,7 +295,6 @@ async def cleanup_stale_user_contexts(max_age_seconds: int) -> int:
     if not _available:
         return 0
 
-    from datetime import timedelta
     cutoff = (datetime.utcnow() - timedelta(seconds=max_age_seconds)).isoformat()
 
     result = await _run(lambda: (
@@ -395,7 +417,6 @@ async def cleanup_stale_youtube_cache(max_age_days: int = 30) -> int:
     if not _available:
         return 0
 
-    from datetime import timedelta
     cutoff = (datetime.utcnow() - timedelta(days=max_age_days)).isoformat()
 
     result = await _run(lambda: (
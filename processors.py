@@ -10,35 +10,64 @@ import json
 import logging
 import base64
 import asyncio
-import subprocess
 import mimetypes
 import re
 import time
 import random
-from typing import Optional, Tuple, List, Dict, Any, AsyncGenerator
-from datetime import timedelta
+import functools
+import importlib.util
+import itertools
+from pathlib import Path
+from typing import Optional, Tuple, List, Dict, Any, AsyncGenerator, Union
 from openai import AsyncOpenAI
 
 import config
 
-# Попытка импорта дополнительных библиотек
-try:
-    import pdfplumber
-    PDFPLUMBER_AVAILABLE = True
-except ImportError:
-    PDFPLUMBER_AVAILABLE = False
-
-try:
-    import docx as python_docx
-    DOCX_AVAILABLE = True
-except ImportError:
-    DOCX_AVAILABLE = False
+# Дополнительные библиотеки: проверяем наличие, но импортируем при первом файле —
+# pdfminer и lxml заметно раздувают RSS и время холодного старта
+PDFPLUMBER_AVAILABLE = importlib.util.find_spec("pdfplumber") is not None
+DOCX_AVAILABLE = importlib.util.find_spec("docx") is not None
 
 logger = logging.getLogger(__name__)
 
 # Хранилище для диалогов о документах
 document_dialogues: Dict[int, Dict[int, Dict[str, Any]]] = {}
 
+# Файл на входе обработчиков: байты или BytesIO в памяти, или путь к файлу на диске.
+# BytesIO — это буфер скачивания aiogram как есть, без копии через getvalue()
+FileSource = Union[bytes, io.BytesIO, str]
+
+
+def _as_file_arg(source: FileSource):
+    """pdfplumber и python-docx принимают и путь, и file-like — байты оборачиваем в BytesIO."""
+    if isinstance(source, bytes):
+        return io.BytesIO(source)
+    return source
+
+
+def _as_buffer(source: Union[bytes, io.BytesIO]):
+    """Содержимое файла в памяти без копии: у BytesIO — memoryview на его буфер."""
+    return source.getbuffer() if isinstance(source, io.BytesIO) else source
+
+
+def _read_bytes(path: str) -> bytes:
+    # Без буферизации read() — это FileIO.readall: буфер сразу по st_size, без промежуточных копий
+    with open(path, 'rb', buffering=0) as f:
+        return f.read()
+
+
+def _write_bytes(path: str, data: bytes) -> None:
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def _remove_files(paths: List[str]) -> None:
+    for p in paths:
+        try:
+            os.remove(p)
+        except OSError:
+            pass
+
 
 # ============================================================================
 # ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ДЛЯ GROQ
@@ -73,15 +102,15 @@ async def _make_groq_request(groq_clients: list, func, *args, **kwargs):
         client_index = order[attempt % client_count]
         client = groq_clients[client_index]
         try:
-            logger.debug(f"Попытка {attempt + 1}/{total_attempts} с клиентом #{client_index}")
+            logger.debug("Попытка %s/%s с клиентом #%s", attempt + 1, total_attempts, client_index)
             return await func(client, *args, **kwargs)
         except Exception as e:
             error_msg = str(e)
             errors.append(f"Клиент {client_index}: {error_msg[:100]}")
-            logger.warning(f"Ошибка запроса (попытка {attempt + 1}): {error_msg[:100]}")
+            logger.warning("Ошибка запроса (попытка %s): %s", attempt + 1, error_msg[:100])
             if "429" in error_msg or "rate_limit" in error_msg.lower():
                 wait_time = 5 + (attempt * 2)
-                logger.info(f"Rate limit, ждем {wait_time}с...")
+                logger.info("Rate limit, ждем %sс...", wait_time)
                 await asyncio.sleep(wait_time)
             else:
                 await asyncio.sleep(1 + (attempt % 3))
@@ -89,6 +118,19 @@ async def _make_groq_request(groq_clients: list, func, *args, **kwargs):
     raise Exception(f"Все клиенты недоступны: {'; '.join(errors[:3])}")
 
 
+# Выбор клиента для стриминга: наименее загруженный, при равенстве — по кругу
+_groq_in_flight: Dict[int, int] = {}   # id(client) → число активных запросов
+_groq_rr = itertools.count()
+
+
+def pick_groq_client(groq_clients: list):
+    """Возвращает клиента с минимумом активных запросов; старт обхода сдвигается по кругу."""
+    n = len(groq_clients)
+    start = next(_groq_rr) % n
+    candidates = (groq_clients[(start + i) % n] for i in range(n))
+    return min(candidates, key=lambda c: _groq_in_flight.get(id(c), 0))
+
+
 def _truncate_text_for_model(text: str, model_type: str) -> str:
     model_limits = {
         "basic": 5000,
@@ -97,7 +139,7 @@ def _truncate_text_for_model(text: str, model_type: str) -> str:
     }
     limit = model_limits.get(model_type, 5000)
     if len(text) > limit:
-        logger.warning(f"Текст обрезан с {len(text)} до {limit} символов для {model_type}")
+        logger.warning("Текст обрезан с %s до %s символов для %s", len(text), limit, model_type)
         return text[:limit] + "... [текст обрезан из-за лимитов API]"
     return text
 
@@ -137,7 +179,7 @@ class VisionProcessor:
         try:
             return await _make_groq_request(self.groq_clients, extract)
         except Exception as e:
-            logger.error(f"Vision OCR error: {e}")
+            logger.error("Vision OCR error: %s", e)
             return f"❌ Ошибка распознавания текста: {str(e)[:100]}"
 
 
@@ -148,32 +190,49 @@ vision_processor = VisionProcessor()
 # VIDEO PROCESSING (только локальные файлы)
 # ============================================================================
 
+async def _run_subprocess(args: list, timeout: float) -> Tuple[int, bytes]:
+    """ffmpeg/ffprobe без блокировки event loop; при таймауте процесс убивается"""
+    proc = await asyncio.create_subprocess_exec(
+        *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        stdout, _ = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise
+    return proc.returncode, stdout
+
+
 class VideoProcessor:
     @staticmethod
     async def check_video_duration(filepath: str) -> Optional[float]:
         try:
-            result = subprocess.run(
+            returncode, stdout = await _run_subprocess(
                 ['ffprobe', '-v', 'error', '-show_entries', 'format=duration',
                  '-of', 'default=noprint_wrappers=1:nokey=1', filepath],
-                capture_output=True, text=True, timeout=10
+                timeout=10
             )
-            if result.returncode == 0 and result.stdout.strip():
-                return float(result.stdout.strip())
+            output = stdout.decode(errors="ignore").strip()
+            if returncode == 0 and output:
+                return float(output)
         except Exception as e:
-            logger.warning(f"Error checking video duration: {e}")
+            logger.warning("Error checking video duration: %s", e)
         return None
 
     @staticmethod
     async def extract_audio_from_video(video_path: str, output_path: str) -> bool:
         try:
-            subprocess.run(
+            await _run_subprocess(
                 ['ffmpeg', '-i', video_path, '-vn', '-acodec', 'libmp3lame',
                  '-ab', '64k', '-ar', str(config.AUDIO_SAMPLE_RATE), '-ac', '1', '-y', output_path],
-                capture_output=True, timeout=300
+                timeout=300
             )
             return os.path.exists(output_path) and os.path.getsize(output_path) > 0
         except Exception as e:
-            logger.error(f"Audio extraction error: {e}")
+            logger.error("Audio extraction error: %s", e)
             return False
 
 
@@ -204,8 +263,15 @@ def _segments_to_timecoded_text(segments: list) -> str:
     return "\n".join(lines)
 
 
-async def transcribe_voice(audio_bytes: bytes, groq_clients: list, with_timecodes: bool = False) -> str:
+async def transcribe_voice(audio_source: FileSource, groq_clients: list, with_timecodes: bool = False) -> str:
+    # Путь отдаём SDK как Path: файл читается при отправке (и заново на ретрае),
+    # а не держится в памяти всё время обработки
+    audio_bytes = Path(audio_source) if isinstance(audio_source, str) else audio_source
+
     async def transcribe(client):
+        # BytesIO SDK дочитывает до конца — на ретрае с другим клиентом отдаём его с начала
+        if isinstance(audio_bytes, io.BytesIO):
+            audio_bytes.seek(0)
         if with_timecodes:
             response = await client.audio.transcriptions.create(
                 model=config.GROQ_MODELS["transcription"],
@@ -231,7 +297,7 @@ async def transcribe_voice(audio_bytes: bytes, groq_clients: list, with_timecode
     try:
         return await _make_groq_request(groq_clients, transcribe)
     except Exception as e:
-        logger.error(f"Transcription error: {e}")
+        logger.error("Transcription error: %s", e)
         return f"❌ Ошибка распознавания: {str(e)[:100]}"
 
 
@@ -239,6 +305,18 @@ async def transcribe_voice(audio_bytes: bytes, groq_clients: list, with_timecode
 # TEXT PROCESSING - CORRECTION
 # ============================================================================
 
+def _instruction_messages(instructions: str, text: str) -> list:
+    """Статичная инструкция — в system, текст — отдельным user-сообщением.
+
+    Префикс запроса байт-в-байт одинаков между вызовами, поэтому
+    срабатывает prefix-кэш Groq.
+    """
+    return [
+        {"role": "system", "content": instructions},
+        {"role": "user", "content": f"Текст:\n{text}"},
+    ]
+
+
 async def correct_text_basic(text: str, groq_clients: list) -> str:
     if not text.strip():
         return config.ERROR_EMPTY_TEXT
@@ -247,7 +325,7 @@ async def correct_text_basic(text: str, groq_clients: list) -> str:
     async def correct(client):
         response = await client.chat.completions.create(
             model=config.GROQ_MODELS["basic"],
-            messages=[{"role": "user", "content": config.BASIC_CORRECTION_PROMPT + f"\n\nТекст:\n{text}"}],
+            messages=_instruction_messages(config.BASIC_CORRECTION_PROMPT, text),
             temperature=config.MODEL_TEMPERATURES["basic"],
         )
         return response.choices[0].message.content.strip()
@@ -255,13 +333,13 @@ async def correct_text_basic(text: str, groq_clients: list) -> str:
     try:
         return await _make_groq_request(groq_clients, correct)
     except Exception as e:
-        logger.error(f"Basic correction error: {e}")
+        logger.error("Basic correction error: %s", e)
         if "413" in str(e) or "rate_limit_exceeded" in str(e):
             shorter = text[:3000] + "... [обрезано]"
             async def retry(client):
                 r = await client.chat.completions.create(
                     model=config.GROQ_MODELS["basic"],
-                    messages=[{"role": "user", "content": config.BASIC_CORRECTION_PROMPT + f"\n\nТекст:\n{shorter}"}],
+                    messages=_instruction_messages(config.BASIC_CORRECTION_PROMPT, shorter),
                     temperature=config.MODEL_TEMPERATURES["basic"],
                 )
                 return r.choices[0].message.content.strip()
@@ -277,7 +355,7 @@ async def correct_text_premium(text: str, groq_clients: list) -> str:
     async def correct(client):
         response = await client.chat.completions.create(
             model=config.GROQ_MODELS["premium"],
-            messages=[{"role": "user", "content": config.PREMIUM_CORRECTION_PROMPT + f"\n\nТекст:\n{text}"}],
+            messages=_instruction_messages(config.PREMIUM_CORRECTION_PROMPT, text),
             temperature=config.MODEL_TEMPERATURES["premium"],
         )
         return response.choices[0].message.content.strip()
@@ -285,13 +363,13 @@ async def correct_text_premium(text: str, groq_clients: list) -> str:
     try:
         return await _make_groq_request(groq_clients, correct)
     except Exception as e:
-        logger.error(f"Premium correction error: {e}")
+        logger.error("Premium correction error: %s", e)
         if "413" in str(e) or "rate_limit_exceeded" in str(e):
             shorter = text[:5000] + "... [обрезано]"
             async def retry(client):
                 r = await client.chat.completions.create(
                     model=config.GROQ_MODELS["premium"],
-                    messages=[{"role": "user", "content": config.PREMIUM_CORRECTION_PROMPT + f"\n\nТекст:\n{shorter}"}],
+                    messages=_instruction_messages(config.PREMIUM_CORRECTION_PROMPT, shorter),
                     temperature=config.MODEL_TEMPERATURES["premium"],
                 )
                 return r.choices[0].message.content.strip()
@@ -316,7 +394,7 @@ async def summarize_text(text: str, groq_clients: list) -> str:
     async def summarize(client):
         response = await client.chat.completions.create(
             model=config.GROQ_MODELS["reasoning"],
-            messages=[{"role": "user", "content": config.SUMMARIZATION_PROMPT + f"\n\nТекст:\n{text}"}],
+            messages=_instruction_messages(config.SUMMARIZATION_PROMPT, text),
             temperature=config.MODEL_TEMPERATURES["reasoning"],
         )
         return response.choices[0].message.content.strip()
@@ -324,13 +402,13 @@ async def summarize_text(text: str, groq_clients: list) -> str:
     try:
         return await _make_groq_request(groq_clients, summarize)
     except Exception as e:
-        logger.error(f"Summarization error: {e}")
+        logger.error("Summarization error: %s", e)
         if "413" in str(e) or "rate_limit_exceeded" in str(e):
             shorter = text[:10000] + "... [обрезано]"
             async def retry(client):
                 r = await client.chat.completions.create(
                     model=config.GROQ_MODELS["reasoning"],
-                    messages=[{"role": "user", "content": config.SUMMARIZATION_PROMPT + f"\n\nТекст:\n{shorter}"}],
+                    messages=_instruction_messages(config.SUMMARIZATION_PROMPT, shorter),
                     temperature=config.MODEL_TEMPERATURES["reasoning"],
                 )
                 return r.choices[0].message.content.strip()
@@ -418,7 +496,7 @@ async def fetch_youtube_subtitles(video_id: str) -> dict:
         try:
             result = ytt.fetch(video_id, languages=["ru", "en"])
         except Exception as e1:
-            logger.debug(f"YT fetch ru/en failed ({type(e1).__name__}): {e1}")
+            logger.debug("YT fetch ru/en failed (%s): %s", type(e1).__name__, e1)
 
         # Попытка 2: любой язык через list_transcripts
         if result is None:
@@ -438,7 +516,7 @@ async def fetch_youtube_subtitles(video_id: str) -> dict:
                     raise Exception("No transcripts found in list")
                 result = transcript.fetch()
             except Exception as e2:
-                logger.debug(f"YT list fallback failed ({type(e2).__name__}): {e2}")
+                logger.debug("YT list fallback failed (%s): %s", type(e2).__name__, e2)
                 raise e2  # пробрасываем реальную ошибку
 
         lang = getattr(result, "language_code", "unknown")
@@ -470,7 +548,7 @@ async def fetch_youtube_subtitles(video_id: str) -> dict:
     except Exception as e:
         err = str(e)
         err_type = type(e).__name__
-        logger.error(f"YouTube subtitles error (type={err_type}): {err}")
+        logger.error("YouTube subtitles error (type=%s): %s", err_type, err)
 
         # Блокировка YouTube на облачном IP (RequestBlocked / IpBlocked)
         if "RequestBlocked" in err_type or "IpBlocked" in err_type or "blocked" in err.lower():
@@ -543,7 +621,7 @@ async def format_subtitles_as_dialogue(raw_text: str, groq_clients: list) -> str
     try:
         return await _make_groq_request(groq_clients, fmt)
     except Exception as e:
-        logger.error(f"Subtitle formatting error: {e}")
+        logger.error("Subtitle formatting error: %s", e)
         # Fallback — возвращаем сырой текст
         return raw_text
 
@@ -600,7 +678,7 @@ async def get_cached_youtube(video_id: str, database=None) -> Optional[Dict[str,
     if subs and _yt_cache_valid(subs["ts"], YT_SUBS_TTL):
         fmt = _yt_fmt_cache.get(video_id)
         fmt_valid = fmt and _yt_cache_valid(fmt["ts"], YT_FMT_TTL)
-        logger.debug(f"YouTube {video_id}: L1 hit (fmt={'yes' if fmt_valid else 'no'})")
+        logger.debug("YouTube %s: L1 hit (fmt=%s)", video_id, 'yes' if fmt_valid else 'no')
         return {
             "segments": subs["segments"],
             "lang": subs["lang"],
@@ -627,7 +705,7 @@ async def get_cached_youtube(video_id: str, database=None) -> Optional[Dict[str,
                     "ts": time.time(),
                 }
                 _yt_cache_evict(_yt_fmt_cache)
-            logger.debug(f"YouTube {video_id}: L2 (Supabase) hit")
+            logger.debug("YouTube %s: L2 (Supabase) hit", video_id)
             return {
                 "segments": row["segments"],
                 "lang": row["lang"],
@@ -708,7 +786,7 @@ async def format_subtitles_cached(
     # 1) L1
     fmt = _yt_fmt_cache.get(video_id)
     if fmt and _yt_cache_valid(fmt["ts"], YT_FMT_TTL):
-        logger.debug(f"YouTube {video_id}: format L1 hit")
+        logger.debug("YouTube %s: format L1 hit", video_id)
         return {"dialogue": fmt["dialogue"], "timecoded": fmt["timecoded"], "source": "memory"}
 
     # 2) LLM
@@ -740,7 +818,7 @@ def clear_youtube_cache(video_id: Optional[str] = None):
     else:
         _yt_subs_cache.clear()
         _yt_fmt_cache.clear()
-    logger.info(f"YouTube in-memory cache cleared: {video_id or 'all'}")
+    logger.info("YouTube in-memory cache cleared: %s", video_id or 'all')
 
 
 # ============================================================================
@@ -810,23 +888,20 @@ async def fetch_url_text(url: str) -> str:
         }
 
         last_error = None
-        for attempt in range(3):
-            if attempt > 0:
-                await asyncio.sleep(2 * attempt)  # 2s, 4s между попытками
-                headers["User-Agent"] = random.choice(user_agents)
+        # Один клиент на все попытки — повтор не платит за новый TCP/TLS
+        async with httpx.AsyncClient(timeout=20, follow_redirects=True) as client:
+            for attempt in range(3):
+                if attempt > 0:
+                    await asyncio.sleep(2 * attempt)  # 2s, 4s между попытками
+                    headers["User-Agent"] = random.choice(user_agents)
 
-            try:
-                async with httpx.AsyncClient(
-                    timeout=20,
-                    follow_redirects=True,
-                    headers=headers,
-                ) as client:
-                    response = await client.get(url)
+                try:
+                    response = await client.get(url, headers=headers)
 
                     if response.status_code == 429:
                         retry_after = int(response.headers.get("Retry-After", 5))
                         wait = min(retry_after, 10)
-                        logger.warning(f"URL 429, waiting {wait}s (attempt {attempt+1})")
+                        logger.warning("URL 429, waiting %ss (attempt %s)", wait, attempt + 1)
                         await asyncio.sleep(wait)
                         last_error = f"429 Too Many Requests"
                         continue
@@ -852,22 +927,22 @@ async def fetch_url_text(url: str) -> str:
                     if len(text) > 30000:
                         text = text[:30000] + "\n... [страница обрезана]"
 
-                    logger.info(f"Fetched URL {url}: {len(text)} chars")
+                    logger.info("Fetched URL %s: %s chars", url, len(text))
                     return text
 
-            except httpx.TimeoutException:
-                last_error = "таймаут соединения"
-                continue
-            except httpx.HTTPStatusError as e:
-                last_error = str(e)
-                break
+                except httpx.TimeoutException:
+                    last_error = "таймаут соединения"
+                    continue
+                except httpx.HTTPStatusError as e:
+                    last_error = str(e)
+                    break
 
         return f"❌ Не удалось загрузить страницу: {last_error or 'неизвестная ошибка'}"
 
     except ImportError:
         return "❌ Для обработки ссылок требуется установить httpx"
     except Exception as e:
-        logger.error(f"URL fetch error: {e}")
+        logger.error("URL fetch error: %s", e)
         return f"❌ Не удалось загрузить страницу: {str(e)[:100]}"
 
 
@@ -919,7 +994,7 @@ async def translate_to_russian(text: str, groq_clients: list) -> str:
     try:
         return await _make_groq_request(groq_clients, translate)
     except Exception as e:
-        logger.error(f"Translation error: {e}")
+        logger.error("Translation error: %s", e)
         return f"❌ Ошибка перевода: {str(e)[:100]}"
 
 
@@ -962,7 +1037,7 @@ async def explain_corrections(original_text: str, corrected_text: str, groq_clie
     try:
         return await _make_groq_request(groq_clients, explain)
     except Exception as e:
-        logger.error(f"Explain corrections error: {e}")
+        logger.error("Explain corrections error: %s", e)
         return f"❌ Ошибка при разборе правок: {str(e)[:100]}"
 
 
@@ -971,9 +1046,7 @@ async def explain_corrections(original_text: str, corrected_text: str, groq_clie
 # ============================================================================
 
 def save_document_for_dialog(user_id: int, msg_id: int, document_text: str, source: str = "unknown"):
-    if user_id not in document_dialogues:
-        document_dialogues[user_id] = {}
-    document_dialogues[user_id][msg_id] = {
+    doc_data = {
         "full_text": document_text,
         "text": document_text,
         "original": document_text,
@@ -981,20 +1054,30 @@ def save_document_for_dialog(user_id: int, msg_id: int, document_text: str, sour
         "timestamp": time.time(),
         "source": source
     }
-    logger.info(f"💾 Документ для диалога: user={user_id}, msg={msg_id}, len={len(document_text)}")
-    return document_dialogues[user_id][msg_id]
+    document_dialogues.setdefault(user_id, {})[msg_id] = doc_data
+    logger.info("💾 Документ для диалога: user=%s, msg=%s, len=%s", user_id, msg_id, len(document_text))
+    return doc_data
 
 
-def get_document_text(user_id: int, msg_id: int) -> Optional[str]:
-    if user_id not in document_dialogues or msg_id not in document_dialogues[user_id]:
-        return None
-    doc_data = document_dialogues[user_id][msg_id]
-    for key in ["full_text", "text", "original"]:
-        if key in doc_data and doc_data[key]:
-            return doc_data[key]
+def get_document(user_id: int, msg_id: int) -> Optional[Dict[str, Any]]:
+    """Документ для диалога за один проход по словарям, без проверок `in` и повторной индексации."""
+    docs = document_dialogues.get(user_id)
+    return docs.get(msg_id) if docs else None
+
+
+def _document_text(doc_data: Dict[str, Any]) -> Optional[str]:
+    for key in ("full_text", "text", "original"):
+        value = doc_data.get(key)
+        if value:
+            return value
     return None
 
 
+def get_document_text(user_id: int, msg_id: int) -> Optional[str]:
+    doc_data = get_document(user_id, msg_id)
+    return _document_text(doc_data) if doc_data else None
+
+
 async def stream_document_answer(
     user_id: int,
     msg_id: int,
@@ -1005,12 +1088,12 @@ async def stream_document_answer(
         yield "❌ Нет доступных Groq клиентов"
         return
 
-    if user_id not in document_dialogues or msg_id not in document_dialogues[user_id]:
+    doc_data = get_document(user_id, msg_id)
+    if doc_data is None:
         yield "❌ Документ не найден. Сначала загрузите документ."
         return
 
-    doc_data = document_dialogues[user_id][msg_id]
-    full_text = get_document_text(user_id, msg_id)
+    full_text = _document_text(doc_data)
     if not full_text:
         yield "❌ Не удалось извлечь текст документа."
         return
@@ -1038,7 +1121,9 @@ async def stream_document_answer(
 Ответь на вопрос, используя только информацию из документа. Если ответа нет в документе, так и скажи.
 Ответ должен быть подробным, но по существу."""
 
-    client = groq_clients[0 % len(groq_clients)]
+    client = pick_groq_client(groq_clients)
+    client_key = id(client)
+    _groq_in_flight[client_key] = _groq_in_flight.get(client_key, 0) + 1
 
     try:
         stream = await client.chat.completions.create(
@@ -1051,13 +1136,14 @@ async def stream_document_answer(
             stream=True,
         )
 
-        full_answer = ""
+        answer_parts: List[str] = []
         async for chunk in stream:
             if chunk.choices and chunk.choices[0].delta.content:
                 piece = chunk.choices[0].delta.content
-                full_answer += piece
+                answer_parts.append(piece)
                 yield piece
 
+        full_answer = "".join(answer_parts)
         history.append({
             "question": question, "answer": full_answer,
             "q": question, "a": full_answer,
@@ -1066,61 +1152,77 @@ async def stream_document_answer(
         doc_data["history"] = history[-config.MAX_DIALOG_HISTORY:]
 
     except Exception as e:
-        logger.error(f"Stream error: {e}", exc_info=True)
+        logger.error("Stream error: %s", e, exc_info=True)
         yield f"❌ Ошибка при генерации ответа: {str(e)[:100]}"
+    finally:
+        _groq_in_flight[client_key] -= 1
 
 
 # ============================================================================
 # FILE PROCESSING
 # ============================================================================
 
-async def process_video_file(video_bytes: bytes, filename: str, groq_clients: list, with_timecodes: bool = False) -> str:
-    try:
-        file_ext = filename.split('.')[-1] if '.' in filename else 'mp4'
-        temp_video_path = f"{config.TEMP_DIR}/video_{int(time.time())}_{os.getpid()}.{file_ext}"
-        temp_audio_path = f"{config.TEMP_DIR}/audio_{int(time.time())}_{os.getpid()}.mp3"
+# Разбор PDF/DOCX — CPU-bound; уводим в потоки, но не больше N сразу
+_extract_semaphore = asyncio.Semaphore(config.MAX_CONCURRENT_EXTRACTIONS)
 
-        with open(temp_video_path, 'wb') as f:
-            f.write(video_bytes)
 
-        duration = await video_processor.check_video_duration(temp_video_path)
-        if duration and duration > 3600:
-            os.remove(temp_video_path)
-            return config.ERROR_VIDEO_TOO_LONG
+async def _run_extraction(func, *args):
+    """Запускает синхронный парсер в thread pool под общим семафором."""
+    async with _extract_semaphore:
+        return await asyncio.to_thread(func, *args)
 
-        if not await video_processor.extract_audio_from_video(temp_video_path, temp_audio_path):
-            os.remove(temp_video_path)
-            return "❌ Ошибка извлечения звука из видео"
 
-        with open(temp_audio_path, 'rb') as f:
-            audio_bytes = f.read()
+# Источник файла: байты в памяти или путь к файлу на диске
+def video_audio_path(video_path: str) -> str:
+    """Куда process_video_file извлекает звук из видео, лежащего на диске."""
+    return os.path.splitext(video_path)[0] + ".mp3"
 
-        text = await transcribe_voice(audio_bytes, groq_clients, with_timecodes=with_timecodes)
 
-        for p in [temp_video_path, temp_audio_path]:
-            try:
-                os.remove(p)
-            except:
-                pass
+async def process_video_file(video_source: FileSource, filename: str, groq_clients: list, with_timecodes: bool = False) -> str:
+    try:
+        file_ext = filename.split('.')[-1] if '.' in filename else 'mp4'
+
+        # Файл уже на диске — ffmpeg читает его напрямую; удаляет его вызывающий
+        owns_video = not isinstance(video_source, str)
+        if owns_video:
+            temp_video_path = f"{config.TEMP_DIR}/video_{int(time.time())}_{os.getpid()}.{file_ext}"
+            temp_audio_path = f"{config.TEMP_DIR}/audio_{int(time.time())}_{os.getpid()}.mp3"
+            await asyncio.to_thread(_write_bytes, temp_video_path, _as_buffer(video_source))
+        else:
+            temp_video_path = video_source
+            temp_audio_path = video_audio_path(video_source)
+
+        try:
+            duration = await video_processor.check_video_duration(temp_video_path)
+            if duration and duration > 3600:
+                return config.ERROR_VIDEO_TOO_LONG
+
+            if not await video_processor.extract_audio_from_video(temp_video_path, temp_audio_path):
+                return "❌ Ошибка извлечения звука из видео"
+
+            text = await transcribe_voice(temp_audio_path, groq_clients, with_timecodes=with_timecodes)
+        finally:
+            await asyncio.to_thread(_remove_files, ([temp_video_path] if owns_video else []) + [temp_audio_path])
 
         return text
 
     except Exception as e:
-        logger.error(f"Error processing video file: {e}")
+        logger.error("Error processing video file: %s", e)
         return f"❌ Ошибка обработки видеофайла: {str(e)[:100]}"
 
 
-async def extract_text_from_pdf(pdf_bytes: bytes) -> str:
+async def extract_text_from_pdf(pdf_source: FileSource) -> str:
     """Извлечение текста из PDF. Тяжёлая работа вынесена в thread чтобы не блокировать event loop."""
     if not PDFPLUMBER_AVAILABLE:
         return "❌ Для работы с PDF требуется установить pdfplumber"
 
     def _extract_sync():
-        pdf_buffer = io.BytesIO(pdf_bytes)
+        import pdfplumber
+
         text = ""
         page_count = 0
 
-        with pdfplumber.open(pdf_buffer) as pdf:
+        with pdfplumber.open(_as_file_arg(pdf_source)) as pdf:
             for page_num, page in enumerate(pdf.pages, 1):
                 if config.PDF_MAX_PAGES and page_num > config.PDF_MAX_PAGES:
                     break
@@ -1144,60 +1246,74 @@ async def extract_text_from_pdf(pdf_bytes: bytes) -> str:
         if not text.strip():
             raise ValueError("Не удалось извлечь текст из PDF")
 
-        logger.info(f"Extracted text from {page_count} PDF pages, {len(pdf_bytes) // 1024} KB")
+        logger.info("Extracted text from %s PDF pages", page_count)
         return text.strip()
 
     try:
-        return await asyncio.to_thread(_extract_sync)
+        return await _run_extraction(_extract_sync)
     except Exception as e:
-        logger.error(f"PDF extraction error: {e}")
+        logger.error("PDF extraction error: %s", e)
         return f"❌ Ошибка обработки PDF: {str(e)}"
 
 
-async def extract_text_from_docx(docx_bytes: bytes) -> str:
+async def extract_text_from_docx(docx_source: FileSource) -> str:
     if not DOCX_AVAILABLE:
         return "❌ Для работы с DOCX требуется установить python-docx"
+
+    def _extract_sync():
+        import docx as python_docx
+
+        doc = python_docx.Document(_as_file_arg(docx_source))
+        return "\n".join(p.text for p in doc.paragraphs if p.text.strip())
+
     try:
-        doc_buffer = io.BytesIO(docx_bytes)
-        doc = python_docx.Document(doc_buffer)
-        text = "\n".join(p.text for p in doc.paragraphs if p.text.strip())
+        text = await _run_extraction(_extract_sync)
         if not text.strip():
             return "❌ Документ пуст"
         return text.strip()
     except Exception as e:
-        logger.error(f"DOCX extraction error: {e}")
+        logger.error("DOCX extraction error: %s", e)
         return f"❌ Ошибка обработки DOCX: {str(e)}"
 
 
 async def extract_text_from_txt(txt_bytes: bytes) -> str:
+    # str(buf, encoding) вместо buf.decode(): работает и с memoryview от BytesIO
     try:
         for encoding in ['utf-8', 'cp1251', 'koi8-r', 'windows-1251']:
             try:
-                return txt_bytes.decode(encoding)
+                return str(txt_bytes, encoding)
             except UnicodeDecodeError:
                 continue
-        return txt_bytes.decode('utf-8', errors='ignore')
+        return str(txt_bytes, 'utf-8', errors='ignore')
     except Exception as e:
-        logger.error(f"TXT reading error: {e}")
+        logger.error("TXT reading error: %s", e)
         return f"❌ Ошибка чтения текстового файла: {str(e)}"
 
 
-async def extract_text_from_file(file_bytes: bytes, filename: str, groq_clients: list) -> str:
+async def extract_text_from_file(file_source: FileSource, filename: str, groq_clients: list) -> str:
+    """
+    file_source — байты (или BytesIO) или путь к скачанному файлу. PDF/DOCX читаются с диска
+    напрямую; изображения и TXT всё равно нужны целиком, их дочитываем в потоке.
+    """
     mime_type, _ = mimetypes.guess_type(filename)
     file_ext = filename.lower().split('.')[-1] if '.' in filename else ''
 
     if mime_type and mime_type.startswith('image/') or file_ext in ['jpg', 'jpeg', 'png', 'bmp', 'gif', 'webp']:
         vision_processor.init_clients(groq_clients)
-        return await vision_processor.extract_text(file_bytes)
+        if isinstance(file_source, str):
+            file_source = await asyncio.to_thread(_read_bytes, file_source)
+        return await vision_processor.extract_text(_as_buffer(file_source))
 
     if mime_type == 'application/pdf' or file_ext == 'pdf':
-        return await extract_text_from_pdf(file_bytes)
+        return await extract_text_from_pdf(file_source)
 
     if mime_type == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document' or file_ext == 'docx':
-        return await extract_text_from_docx(file_bytes)
+        return await extract_text_from_docx(file_source)
 
     if mime_type == 'text/plain' or file_ext == 'txt':
-        return await extract_text_from_txt(file_bytes)
+        if isinstance(file_source, str):
+            file_source = await asyncio.to_thread(_read_bytes, file_source)
+        return await extract_text_from_txt(_as_buffer(file_source))
 
     if file_ext == 'doc':
         return config.ERROR_DOC_NOT_SUPPORTED
@@ -1209,61 +1325,80 @@ async def extract_text_from_file(file_bytes: bytes, filename: str, groq_clients:
 # ЭКСПОРТ В ФАЙЛЫ
 # ============================================================================
 
-async def save_to_txt(text: str, filepath: str) -> bool:
+def _write_atomic(filepath: str, write) -> None:
+    """Пишет через {filepath}.tmp + os.replace: отправка никогда не увидит недописанный файл."""
+    tmp_path = f"{filepath}.tmp"
     try:
-        def _write():
-            with open(filepath, "w", encoding="utf-8") as f:
-                f.write(text)
-        await asyncio.to_thread(_write)
-        return True
-    except Exception as e:
-        logger.error(f"TXT save error: {e}")
-        return False
+        write(tmp_path)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _render_pdf_sync(text: str, filepath: str) -> None:
+    """Рендер PDF; синхронный, вызывается из save_to_pdf через asyncio.to_thread."""
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.utils import simpleSplit
+    from datetime import datetime
+
+    width, height = A4
+    margin = 50
+    line_height = 14
+    bottom = margin + 20
+    max_width = width - 2 * margin
+
+    # Перенос строк считаем один раз на весь текст; пустой абзац — пустая строка
+    lines: List[str] = []
+    for paragraph in text.split('\n'):
+        if paragraph.strip():
+            lines.extend(simpleSplit(paragraph, "Helvetica", 11, max_width))
+        else:
+            lines.append("")
+
+    with open(filepath, "wb", buffering=1 << 16) as fh:
+        c = canvas.Canvas(fh, pagesize=A4, pageCompression=1)
+        y = height - margin
+
+        c.setFont("Helvetica-Bold", 14)
+        c.drawString(margin, y, "Обработанный текст")
+        y -= 30
+        c.setFont("Helvetica", 10)
+        c.drawString(margin, y, f"Создано: {datetime.now().strftime('%d.%m.%Y %H:%M')}")
+        y -= 40
+
+        # Одна текстовая группа на страницу вместо drawString на каждую строку
+        start = 0
+        while True:
+            per_page = int((y - bottom) // line_height) + 1
+            text_obj = c.beginText(margin, y)
+            text_obj.setFont("Helvetica", 11)
+            text_obj.setLeading(line_height)
+            text_obj.textLines(lines[start:start + per_page], trim=0)
+            c.drawText(text_obj)
+            start += per_page
+            if start >= len(lines):
+                break
+            c.showPage()
+            y = height - margin
+        c.save()
 
 
 async def save_to_pdf(text: str, filepath: str) -> bool:
+    # Рендер в потоке: пул процессов со spawn перезапускал бы bot.py (__mp_main__)
+    # в каждом воркере — по целому лишнему боту на маленьком инстансе
     try:
-        def _write():
-            from reportlab.lib.pagesizes import A4
-            from reportlab.pdfgen import canvas
-            from reportlab.lib.utils import simpleSplit
-
-            c = canvas.Canvas(filepath, pagesize=A4)
-            width, height = A4
-            margin = 50
-            line_height = 14
-            y = height - margin
-
-            c.setFont("Helvetica-Bold", 14)
-            c.drawString(margin, y, "Обработанный текст")
-            y -= 30
-            c.setFont("Helvetica", 10)
-            from datetime import datetime
-            c.drawString(margin, y, f"Создано: {datetime.now().strftime('%d.%m.%Y %H:%M')}")
-            y -= 40
-            c.setFont("Helvetica", 11)
-            max_width = width - 2 * margin
-
-            for paragraph in text.split('\n'):
-                if not paragraph.strip():
-                    y -= line_height
-                    continue
-                for line in simpleSplit(paragraph, "Helvetica", 11, max_width):
-                    if y < margin + 20:
-                        c.showPage()
-                        y = height - margin
-                        c.setFont("Helvetica", 11)
-                    c.drawString(margin, y, line)
-                    y -= line_height
-            c.save()
-
-        await asyncio.to_thread(_write)
+        await asyncio.to_thread(_write_atomic, filepath, functools.partial(_render_pdf_sync, text))
         return True
     except ImportError:
         logger.warning("reportlab not installed, falling back to txt")
         return False
     except Exception as e:
-        logger.error(f"PDF save error: {e}")
+        logger.error("PDF save error: %s", e)
         return False
 
 
@@ -1274,7 +1409,7 @@ async def save_to_docx(text: str, filepath: str) -> bool:
         return False
 
     try:
-        def _write():
+        def _write(path):
             from docx import Document as DocxDocument
             from docx.shared import Pt, Inches
             from docx.enum.text import WD_ALIGN_PARAGRAPH
@@ -1298,12 +1433,12 @@ async def save_to_docx(text: str, filepath: str) -> bool:
                 p = doc.add_paragraph(line)
                 p.runs[0].font.size = Pt(11) if p.runs else None
 
-            doc.save(filepath)
+            doc.save(path)
 
-        await asyncio.to_thread(_write)
+        await asyncio.to_thread(_write_atomic, filepath, _write)
         return True
     except Exception as e:
-        logger.error(f"DOCX save error: {e}")
+        logger.error("DOCX save error: %s", e)
         return False
 
 
@@ -1344,7 +1479,7 @@ async def breakdown_corrections(original_text: str, corrected_text: str, groq_cl
     try:
         return await _make_groq_request(groq_clients, analyze)
     except Exception as e:
-        logger.error(f"Breakdown error: {e}")
+        logger.error("Breakdown error: %s", e)
         return f"❌ Ошибка при разборе: {str(e)[:100]}"
 
 
@@ -1352,12 +1487,17 @@ async def breakdown_corrections(original_text: str, corrected_text: str, groq_cl
 # ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ
 # ============================================================================
 
+_WORD_RE = re.compile(r"\S+")
+
+
 def get_available_modes(text: str) -> list:
-    words_count = len(text.split())
-    text_length = len(text)
     available = ["basic", "premium"]
-    if words_count >= config.MIN_WORDS_FOR_SUMMARY and text_length >= config.MIN_CHARS_FOR_SUMMARY:
-        available.append("summary")
+    # Длина — O(1), поэтому проверяется первой; слова считаем только до порога,
+    # не строя список всех слов многомегабайтного текста
+    if len(text) >= config.MIN_CHARS_FOR_SUMMARY:
+        words = itertools.islice(_WORD_RE.finditer(text), config.MIN_WORDS_FOR_SUMMARY)
+        if sum(1 for _ in words) >= config.MIN_WORDS_FOR_SUMMARY:
+            available.append("summary")
     return available
 
 
@@ -1376,9 +1516,10 @@ __all__ = [
     'vision_processor',
     'save_document_for_dialog',
     'stream_document_answer',
+    'pick_groq_client',
+    'get_document',
     'get_document_text',
     'document_dialogues',
-    'save_to_txt',
     'save_to_pdf',
     'save_to_docx',
     'explain_corrections',